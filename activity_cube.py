@@ -0,0 +1,184 @@
+import numpy as np
+import pandas as pd
+
+from hll import estimate_cardinality, hash_user_ids, register_updates
+
+# Часов в сутках - вторая ось куба
+HOURS = 24
+
+# Точность скетчей ячеек: 2^10 регистров (1 КБ на ячейку), стандартная ошибка ≈ 3%;
+# до ~2500 уникальных пользователей в ячейке оценка почти точная (linear counting)
+CUBE_PRECISION = 10
+
+# Скользящие окна (в днях)
+ROLLING_WINDOWS = (7, 30)
+
+# Меры тепловых карт: ключ -> подпись
+HEATMAP_MEASURES = {
+    'users': 'Уникальные пользователи',
+    'paying': 'Платящие пользователи',
+    'amount': 'Сумма оплат (старс)',
+}
+
+# Начало отсчета часов ячеек
+EPOCH_DAY = np.datetime64('1970-01-01', 'D')
+
+
+# Функция для построения куба активности (час × день) по обработанному файлу
+def build_cube(df, paid, precision=CUBE_PRECISION):
+    """Возвращает куб - словарь массивов по непустым ячейкам (час от начала эпохи), отсортированным по времени:
+
+    hours - номера ячеек (день от EPOCH_DAY * 24 + час),
+    transactions, paid_transactions, amount - суммы по ячейкам (складываются при объединении),
+    users, paying - регистры HyperLogLog уникальных и платящих пользователей ячеек (объединяются максимумом).
+    Строки без даты или часа в куб не попадают; None, если таких строк нет или колонки Hour нет.
+    """
+    if 'Hour' not in df.columns or 'Date' not in df.columns:
+        return None
+
+    hour_values = pd.to_numeric(df['Hour'], errors='coerce')
+    known = (df['Date'].notna() & hour_values.between(0, HOURS - 1)).to_numpy()
+    if not known.any():
+        return None
+
+    days = (df['Date'].to_numpy(dtype='datetime64[D]')[known] - EPOCH_DAY).astype(np.int64)
+    cells = days * HOURS + hour_values.to_numpy()[known].astype(np.int64)
+    hours, cell_index = np.unique(cells, return_inverse=True)
+
+    paid = paid.to_numpy()[known]
+    amount = pd.to_numeric(df['Amount'], errors='coerce').fillna(0.0).to_numpy()[known]
+
+    users = np.zeros((hours.size, 1 << precision), dtype=np.uint8)
+    paying = np.zeros_like(users)
+    known_user = df['UserId'].notna().to_numpy()[known]
+    if known_user.any():
+        user_cells = cell_index[known_user]
+        index, rank = register_updates(hash_user_ids(df['UserId'][known]), precision)
+        np.maximum.at(users, (user_cells, index), rank)
+        paid_user = paid[known_user]
+        np.maximum.at(paying, (user_cells[paid_user], index[paid_user]), rank[paid_user])
+
+    return {
+        'hours': hours,
+        'transactions': np.bincount(cell_index, minlength=hours.size).astype(np.int64),
+        'paid_transactions': np.bincount(cell_index[paid], minlength=hours.size).astype(np.int64),
+        'amount': np.bincount(cell_index[paid], weights=amount[paid], minlength=hours.size),
+        'users': users,
+        'paying': paying,
+    }
+
+
+# Функция для объединения кубов (файлов, дней, периода)
+def merge_cubes(cubes):
+    """Суммы ячеек складываются, регистры объединяются поэлементным максимумом.
+    Работа пропорциональна числу ячеек, а не строк: новые файлы добавляются к дню за время O(ячеек)"""
+    cubes = [cube for cube in cubes if cube is not None]
+    if not cubes:
+        return None
+    if len(cubes) == 1:
+        return cubes[0]
+
+    cells = np.concatenate([cube['hours'] for cube in cubes])
+    order = np.argsort(cells, kind='stable')
+    cells = cells[order]
+    # Начала групп одинаковых ячеек в отсортированном массиве
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+
+    merged = {'hours': cells[starts]}
+    for name in ('transactions', 'paid_transactions', 'amount'):
+        merged[name] = np.add.reduceat(np.concatenate([cube[name] for cube in cubes])[order], starts)
+    for name in ('users', 'paying'):
+        merged[name] = np.maximum.reduceat(np.concatenate([cube[name] for cube in cubes])[order], starts, axis=0)
+    return merged
+
+
+# Функция для подсчета памяти, занимаемой кубом (в байтах)
+def cube_memory_usage(cube):
+    if cube is None:
+        return 0
+    return int(sum(values.nbytes for values in cube.values()))
+
+
+# Функция для получения диапазона дней куба
+def cube_days(cube):
+    """Возвращает массив дней datetime64[D] от первого до последнего дня с данными (включая пустые дни)"""
+    first, last = cube['hours'][0] // HOURS, cube['hours'][-1] // HOURS
+    return EPOCH_DAY + np.arange(first, last + 1)
+
+
+# Функция для развертывания меры куба в плотную сетку день × час
+def cube_grid(cube, measure):
+    """measure - 'users', 'paying' (оценки HLL) или 'transactions', 'paid_transactions', 'amount'.
+    Возвращает массив формы (дней, 24); пустые ячейки - нули"""
+    days = cube_days(cube)
+    grid = np.zeros(days.size * HOURS)
+    values = cube[measure]
+    if values.ndim == 2:
+        values = estimate_cardinality(values)
+    grid[cube['hours'] - cube['hours'][0] // HOURS * HOURS] = values
+    return grid.reshape(days.size, HOURS)
+
+
+# Функция для получения таблицы тепловой карты (длинный формат для графика)
+def cube_heatmap(cube, measure):
+    """Возвращает DataFrame (Дата, Час, Значение) - дней × 24 строки, независимо от числа исходных строк"""
+    days = cube_days(cube)
+    grid = cube_grid(cube, measure)
+    if measure in ('users', 'paying'):
+        grid = np.round(grid)
+    return pd.DataFrame({
+        'Дата': np.repeat(pd.to_datetime(days).strftime('%Y-%m-%d'), HOURS),
+        'Час': np.tile(np.arange(HOURS), days.size),
+        'Значение': grid.ravel(),
+    })
+
+
+# Функция для расчета скользящих окон по дням
+def rolling_windows(cube, windows=ROLLING_WINDOWS):
+    """Возвращает DataFrame по дням: сумма оплат, транзакции и уникальные пользователи за последние N дней.
+
+    Суммы берутся разностью накопленных сумм по дням (O(дней) на окно). Уникальные пользователи окна -
+    оценка HLL по объединению (максимуму) дневных регистров, объединение по окну строится удвоением:
+    O(дней × log(окна)) операций над регистрами."""
+    days = cube_days(cube)
+    day_index = cube['hours'] // HOURS - cube['hours'][0] // HOURS
+
+    result = {'Date': pd.to_datetime(days)}
+    for name, label in (('amount', 'Сумма оплат'), ('transactions', 'Транзакции')):
+        daily = np.bincount(day_index, weights=cube[name], minlength=days.size)
+        cumulative = np.r_[0.0, np.cumsum(daily)]
+        for window in windows:
+            starts = np.maximum(np.arange(days.size) + 1 - window, 0)
+            result[f"{label} за {window} дн."] = cumulative[1:] - cumulative[starts]
+
+    # Дневные регистры - максимум регистров часов дня
+    registers = np.zeros((days.size, cube['users'].shape[1]), dtype=np.uint8)
+    np.maximum.at(registers, day_index, cube['users'])
+    for window in windows:
+        result[f"Пользователи за {window} дн."] = np.round(
+            estimate_cardinality(window_union(registers, window))
+        ).astype(np.int64)
+
+    return pd.DataFrame(result)
+
+
+# Функция для объединения регистров по скользящему окну (максимум по последним window строкам)
+def window_union(registers, window):
+    """Максимум по окнам длины 2^k строится удвоением, окно произвольной длины - из двух перекрывающихся степеней двойки"""
+    count = registers.shape[0]
+    window = max(1, min(window, count))
+    power = 1
+    levels = registers
+    while power * 2 <= window:
+        # levels[i] - максимум строк i - 2 * power + 1 .. i
+        shifted = np.zeros_like(levels)
+        shifted[power:] = levels[:-power]
+        levels = np.maximum(levels, shifted)
+        power *= 2
+
+    # Окно [i - window + 1, i] = [i - power + 1, i] ∪ [i - window + 1, i - window + power]
+    shifted = np.zeros_like(levels)
+    offset = window - power
+    if offset:
+        shifted[offset:] = levels[:-offset]
+    return np.maximum(levels, shifted)
@@ -0,0 +1,237 @@
+"""Бенчмарк конвейера загрузки и расчета метрик на синтетических данных.
+
+Файлы генерируются в локальную замену S3 (каталог на диске или moto), затем по этапам замеряются
+время, пропускная способность (файлы/с, строки/с, МБ/с), задержка на файл (p50/p95) и пиковая память:
+
+    python benchmarks/bench_pipeline.py --sizes 50,200,1000
+    python benchmarks/bench_pipeline.py --sizes 288 --malformed-share 0.01 --json bench.jsonl
+
+Эмуляция S3 через moto (--backend moto) требует отдельной установки: pip install "moto[s3]"
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+import numpy as np
+
+# Кэш обработанных файлов - во временном каталоге, до импорта модулей дашборда
+CACHE_ROOT = Path(tempfile.mkdtemp(prefix='gift-bench-cache-'))
+os.environ['GIFT_DASHBOARD_CACHE_DIR'] = str(CACHE_ROOT)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from log_parsing import process_json_data  # noqa: E402
+from metrics import compute_rollup_metrics  # noqa: E402
+from rollups import build_rollup, merge_rollups  # noqa: E402
+from s3_source import DEFAULT_MAX_WORKERS, list_files_in_bucket, load_file_from_s3, load_files_concurrently  # noqa: E402
+from synthetic import COMPRESSIONS, FORMATS, LocalS3Client, populate_bucket  # noqa: E402
+
+BUCKET_NAME = 'gift-benchmark'
+PREFIX = 'processed-logs/funds-log/5min/'
+
+
+# Функция для замера времени и пиковой памяти блока
+@contextmanager
+def measure(result, trace_memory=True):
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        result['seconds'] = time.perf_counter() - started
+        if trace_memory:
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            tracemalloc.stop()
+
+
+# Функция для заполнения строки результата производными показателями
+def finish_stage(result, files, rows, size, latencies=None):
+    seconds = max(result['seconds'], 1e-9)
+    result.update({
+        'files': files,
+        'rows': rows,
+        'files_per_s': files / seconds,
+        'rows_per_s': rows / seconds,
+        'mb_per_s': size / 1024 ** 2 / seconds,
+    })
+    if latencies:
+        result['p50_ms'] = float(np.percentile(latencies, 50) * 1000)
+        result['p95_ms'] = float(np.percentile(latencies, 95) * 1000)
+    return result
+
+
+# Функция для прогона всех этапов на одном размере набора данных
+def run_size(s3_client, files, args):
+    """Возвращает список результатов по этапам"""
+    bucket_name = f"{BUCKET_NAME}-{files}"
+    s3_client.create_bucket(Bucket=bucket_name)
+    days, rows, size = populate_bucket(
+        s3_client, bucket_name, PREFIX, files,
+        users=args.users, transactions=args.transactions,
+        test_share=args.test_share, malformed_share=args.malformed_share,
+        formats=args.formats, seed=args.seed, compression=args.compression
+    )
+    results = []
+
+    def stage(name):
+        result = {'size': files, 'stage': name}
+        results.append(result)
+        return result
+
+    # Листинг по дневным подпрефиксам
+    result = stage('list')
+    with measure(result, args.trace_memory):
+        file_list, error = list_files_in_bucket(s3_client, bucket_name, PREFIX, days=days)
+    if error:
+        raise RuntimeError(error)
+    finish_stage(result, len(file_list), rows, size)
+
+    # Загрузка и разбор байт (последовательно, чтобы видеть задержку одного файла)
+    result = stage('fetch_parse')
+    payloads = []
+    latencies = []
+    with measure(result, args.trace_memory):
+        for file_obj in file_list:
+            started = time.perf_counter()
+            payloads.append((file_obj['Key'], load_file_from_s3(s3_client, bucket_name, file_obj['Key'])[0]))
+            latencies.append(time.perf_counter() - started)
+    finish_stage(result, len(file_list), rows, size, latencies)
+
+    # Нормализация в DataFrame
+    result = stage('process')
+    frames = []
+    latencies = []
+    with measure(result, args.trace_memory):
+        for file_key, json_data in payloads:
+            started = time.perf_counter()
+            df, _ = process_json_data(json_data, file_key)
+            latencies.append(time.perf_counter() - started)
+            frames.append(df)
+    finish_stage(result, len(frames), rows, size, latencies)
+    del payloads
+
+    # Агрегаты файлов
+    result = stage('rollup')
+    latencies = []
+    with measure(result, args.trace_memory):
+        rollups = []
+        for df in frames:
+            started = time.perf_counter()
+            rollups.append(build_rollup(df))
+            latencies.append(time.perf_counter() - started)
+    finish_stage(result, len(rollups), rows, size, latencies)
+    del frames
+
+    result = stage('merge')
+    with measure(result, args.trace_memory):
+        combined = merge_rollups(rollups)
+    finish_stage(result, len(rollups), rows, size)
+
+    result = stage('metrics')
+    with measure(result, args.trace_memory):
+        compute_rollup_metrics(combined)
+    finish_stage(result, 1, rows, size)
+
+    # Полный путь дашборда: параллельная загрузка с холодным и прогретым локальным кэшем
+    for name in ('ingest_cold', 'ingest_warm'):
+        if name == 'ingest_cold':
+            for path in sorted(CACHE_ROOT.rglob('*'), reverse=True):
+                path.unlink() if path.is_file() else path.rmdir()
+        result = stage(name)
+        with measure(result, args.trace_memory):
+            loaded = [
+                rollup for _, _, rollup, error, _ in
+                load_files_concurrently(s3_client, bucket_name, file_list, args.max_workers)
+                if not error
+            ]
+        finish_stage(result, len(loaded), rows, size)
+
+    return results
+
+
+# Функция для вывода результатов таблицей
+def print_results(results):
+    columns = [
+        ('size', 'файлов', '{:>7}'), ('stage', 'этап', '{:<12}'), ('seconds', 'сек', '{:>9.3f}'),
+        ('files_per_s', 'файл/с', '{:>9.1f}'), ('rows_per_s', 'строк/с', '{:>11.0f}'),
+        ('mb_per_s', 'МБ/с', '{:>8.1f}'), ('p50_ms', 'p50 мс', '{:>8.2f}'), ('p95_ms', 'p95 мс', '{:>8.2f}'),
+        ('peak_mb', 'пик МБ', '{:>8.1f}'),
+    ]
+    print(' '.join(f"{title:>{len(fmt.format(0) if 'f' in fmt else fmt.format(''))}}" for _, title, fmt in columns))
+    for result in results:
+        cells = []
+        for key, _, fmt in columns:
+            value = result.get(key)
+            width = len(fmt.format(0) if 'f' in fmt else fmt.format(''))
+            cells.append(fmt.format(value) if value is not None else ' ' * (width - 1) + '-')
+        print(' '.join(cells))
+
+
+# Функция для разбора аргументов командной строки
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк загрузки и расчета метрик на синтетических данных')
+    parser.add_argument('--sizes', default='50,200', help='Размеры наборов (количество 5-минутных файлов) через запятую')
+    parser.add_argument('--users', type=int, default=10_000, help='Количество различных пользователей')
+    parser.add_argument('--transactions', type=int, default=200, help='Транзакций в одном файле')
+    parser.add_argument('--test-share', type=float, default=0.01, help='Доля записей TestMode=true')
+    parser.add_argument('--malformed-share', type=float, default=0.0, help='Доля битых строк в NDJSON-файлах')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='Форматы файлов через запятую (чередуются)')
+    parser.add_argument('--compression', choices=list(COMPRESSIONS), help='Сжимать файлы (.json.gz / .json.zst)')
+    parser.add_argument('--backend', choices=('local', 'moto'), default='local',
+                        help='local - каталог на диске, moto - эмуляция S3 в памяти (нужен пакет moto)')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS, help='Параллельных загрузок')
+    parser.add_argument('--no-memory', dest='trace_memory', action='store_false',
+                        help='Не замерять пиковую память (tracemalloc замедляет этапы)')
+    parser.add_argument('--seed', type=int, default=0, help='Зерно генератора')
+    parser.add_argument('--json', help='Дописать результаты в файл JSONL')
+    args = parser.parse_args(argv)
+    args.sizes = [int(size) for size in args.sizes.split(',') if size]
+    args.formats = tuple(file_format for file_format in args.formats.split(',') if file_format)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Логи по каждому файлу искажают замеры
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.backend == 'moto':
+        import boto3
+        from moto import mock_aws
+        context = mock_aws()
+    else:
+        context = nullcontext()
+
+    results = []
+    try:
+        with context, tempfile.TemporaryDirectory(prefix='gift-bench-s3-') as s3_root:
+            if args.backend == 'moto':
+                s3_client = boto3.client('s3', region_name='us-east-1')
+            else:
+                s3_client = LocalS3Client(s3_root)
+
+            for files in args.sizes:
+                results.extend(run_size(s3_client, files, args))
+    finally:
+        shutil.rmtree(CACHE_ROOT, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'a') as f:
+            for result in results:
+                f.write(json.dumps({**result, 'backend': args.backend, 'formats': list(args.formats), 'compression': args.compression}) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
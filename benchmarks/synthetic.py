@@ -0,0 +1,170 @@
+"""Генерация синтетических 5-минутных файлов funds-log и локальная замена S3 для бенчмарков."""
+import hashlib
+import io
+import json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+# Форматы файлов, которые принимает process_json_data:
+# records - JSON-массив объектов, table - массив списков с заголовком, ndjson - объект на строку
+FORMATS = ('records', 'table', 'ndjson')
+
+# Поля записи funds-log
+FIELDS = ['UserId', 'InvoiceType', 'Amount', 'Timestamp', 'TestMode']
+
+# Типичные суммы оплат (старс)
+AMOUNTS = np.array([1, 5, 10, 25, 50, 100, 250])
+
+# Сколько 5-минутных файлов в сутках
+FILES_PER_DAY = 24 * 12
+
+# Сжатие файлов: кодек Arrow -> расширение ключа
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+# Функция для генерации записей одного 5-минутного файла
+def generate_records(rng, file_start, users=10_000, transactions=200, test_share=0.01):
+    """Пользователи распределены неравномерно: небольшая часть делает большинство транзакций"""
+    user_ids = (users * rng.random(transactions) ** 3).astype(np.int64) + 1
+    invoice_types = rng.choice([0, 1, 2], size=transactions, p=[0.5, 0.4, 0.1])
+    amounts = np.where(invoice_types == 1, rng.choice(AMOUNTS, size=transactions), 0)
+    timestamps = int(file_start.timestamp()) + np.sort(rng.integers(0, 300, size=transactions))
+    test_mode = rng.random(transactions) < test_share
+
+    return [
+        {
+            'UserId': int(user_id),
+            'InvoiceType': int(invoice_type),
+            'Amount': int(amount),
+            'Timestamp': int(timestamp),
+            'TestMode': bool(test),
+        }
+        for user_id, invoice_type, amount, timestamp, test in zip(
+            user_ids, invoice_types, amounts, timestamps, test_mode
+        )
+    ]
+
+
+# Функция для кодирования записей в один из форматов
+def encode_records(records, file_format, rng=None, malformed_share=0.0):
+    """Битые строки добавляются только в ndjson: в едином JSON-документе они испортили бы весь файл"""
+    if file_format == 'records':
+        return json.dumps(records).encode('utf-8')
+    if file_format == 'table':
+        rows = [FIELDS] + [[record[field] for field in FIELDS] for record in records]
+        return json.dumps(rows).encode('utf-8')
+    if file_format == 'ndjson':
+        lines = [json.dumps(record) for record in records]
+        if rng is not None and malformed_share > 0:
+            for i in np.flatnonzero(rng.random(len(lines)) < malformed_share):
+                # Обрезанная запись - типичный результат прерванной записи файла
+                lines[i] = lines[i][:len(lines[i]) // 2]
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+    raise ValueError(f"Неизвестный формат: {file_format}")
+
+
+# Функция для заполнения бакета синтетическими файлами
+def populate_bucket(s3_client, bucket_name, prefix, files, start_day='2025-04-09', users=10_000,
+                    transactions=200, test_share=0.01, malformed_share=0.0, formats=FORMATS, seed=0,
+                    compression=None):
+    """Создает files 5-минутных файлов подряд начиная с start_day, форматы чередуются.
+    compression - 'gzip' или 'zstd' (ключи .json.gz / .json.zst).
+    Возвращает (список дней, количество записей, размер в байтах после сжатия)"""
+    rng = np.random.default_rng(seed)
+    start = datetime.fromisoformat(start_day).replace(tzinfo=timezone.utc)
+    days = set()
+    rows = 0
+    size = 0
+
+    for i in range(files):
+        file_start = start + timedelta(minutes=5 * i)
+        records = generate_records(rng, file_start, users, transactions, test_share)
+        body = encode_records(records, formats[i % len(formats)], rng, malformed_share)
+        key = f"{prefix}{file_start:%Y-%m-%d-%H-%M}.json"
+        if compression:
+            body = pa.compress(body, codec=compression, asbytes=True)
+            key += COMPRESSIONS[compression]
+        s3_client.put_object(Bucket=bucket_name, Key=key, Body=body)
+
+        days.add(file_start.date().isoformat())
+        rows += len(records)
+        size += len(body)
+
+    return sorted(days), rows, size
+
+
+class LocalS3Client:
+    """Минимальная замена клиента S3 поверх каталога: только вызовы, которые использует дашборд"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, bucket_name, key):
+        return self.root / bucket_name / key
+
+    def create_bucket(self, Bucket, **kwargs):
+        (self.root / Bucket).mkdir(parents=True, exist_ok=True)
+
+    def list_buckets(self):
+        return {'Buckets': [{'Name': path.name} for path in self.root.iterdir() if path.is_dir()]}
+
+    def put_object(self, Bucket, Key, Body):
+        path = self._path(Bucket, Key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(Body)
+        return {'ETag': f'"{hashlib.md5(Body).hexdigest()}"'}
+
+    def get_object(self, Bucket, Key):
+        data = self._path(Bucket, Key).read_bytes()
+        return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+
+    def list_objects_v2(self, Bucket, Prefix='', StartAfter='', ContinuationToken=None, MaxKeys=1000):
+        bucket_root = self.root / Bucket
+        keys = sorted(
+            path.relative_to(bucket_root).as_posix()
+            for path in bucket_root.rglob('*') if path.is_file()
+        )
+        after = ContinuationToken or StartAfter or ''
+        keys = [key for key in keys if key.startswith(Prefix) and key > after]
+
+        page = keys[:MaxKeys]
+        response = {
+            'Contents': [
+                {
+                    'Key': key,
+                    'Size': self._path(Bucket, key).stat().st_size,
+                    # Как у S3 для обычной загрузки - MD5 содержимого в кавычках
+                    'ETag': f'"{hashlib.md5(self._path(Bucket, key).read_bytes()).hexdigest()}"',
+                }
+                for key in page
+            ],
+            'IsTruncated': len(keys) > MaxKeys,
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+    def get_paginator(self, operation_name):
+        if operation_name != 'list_objects_v2':
+            raise NotImplementedError(operation_name)
+        return LocalPaginator(self)
+
+
+class LocalPaginator:
+    """Постраничный обход list_objects_v2 для LocalS3Client"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, **params):
+        token = None
+        while True:
+            page = self.client.list_objects_v2(ContinuationToken=token, **params)
+            yield page
+            if not page['IsTruncated']:
+                return
+            token = page['NextContinuationToken']
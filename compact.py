@@ -0,0 +1,206 @@
+"""Сжатие 5-минутных JSON-файлов закрытых дней в дневные Parquet-разделы.
+
+Запускается без Streamlit, например по расписанию:
+
+    python compact.py --bucket technicalgiftagram --start 2025-04-09 --end 2025-05-01
+    python compact.py --output-dir ./daily --start 2025-04-09
+
+Учетные данные берутся из стандартной цепочки boto3 (переменные окружения, ~/.aws, роль).
+Раздел дня пишется в соседний префикс (по умолчанию .../daily/<день>.parquet) или в локальный каталог;
+дашборд читает такие разделы вместо 5-минутных файлов закрытых дней.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from s3_source import (
+    DEFAULT_MAX_WORKERS,
+    MIN_DATE,
+    compacted_key,
+    connect_to_s3,
+    days_in_range,
+    default_compacted_prefix,
+    fetch_and_process_file,
+    is_day_closed,
+    list_compacted_days,
+    list_files_in_bucket,
+)
+from schema import concat_frames
+
+logger = logging.getLogger('gift-dashboard')
+
+# Ключ метаданных Parquet со статистикой раздела
+STATS_METADATA_KEY = b'gift_dashboard.stats'
+
+# Размер группы строк: статистика min/max пишется для каждой группы
+ROW_GROUP_SIZE = 128 * 1024
+
+
+# Функция для сборки DataFrame дня из его 5-минутных файлов
+def compact_day(s3_client, bucket_name, prefix, day, max_workers=DEFAULT_MAX_WORKERS):
+    """Возвращает (DataFrame, статистика, ошибка). Раздел собирается только если прочитаны все файлы дня"""
+    file_list, file_error = list_files_in_bucket(s3_client, bucket_name, prefix, days=[day])
+    if file_error:
+        return None, None, file_error
+    if not file_list:
+        return None, None, None
+
+    file_list = sorted(file_list, key=lambda obj: obj['Key'])
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-compact') as executor:
+        results = list(executor.map(
+            lambda file_obj: fetch_and_process_file(s3_client, bucket_name, file_obj), file_list
+        ))
+
+    errors = [error for _, error, _ in results if error]
+    if errors:
+        return None, None, f"Не удалось прочитать {len(errors)} из {len(file_list)} файлов дня {day}: {errors[0]}"
+
+    # Пустые 5-минутные файлы прочитаны успешно, но строк в раздел не добавляют
+    df = concat_frames([df for df, _, _ in results if not df.empty])
+    if df is None or df.empty:
+        return None, None, None
+    if 'Datetime' in df.columns:
+        df = df.sort_values('Datetime', kind='stable', ignore_index=True)
+
+    # Отпечаток исходных файлов: по нему видно, из каких версий объектов собран раздел
+    fingerprint = ''
+    for file_obj in file_list:
+        fingerprint = hashlib.sha1(
+            f"{fingerprint}|{file_obj['Key']}|{file_obj.get('ETag')}".encode('utf-8')
+        ).hexdigest()
+
+    stats = {
+        'day': day,
+        'rows': int(len(df)),
+        'files': len(file_list),
+        'first_key': file_list[0]['Key'],
+        'last_key': file_list[-1]['Key'],
+        'source_fingerprint': fingerprint,
+        'users': int(df['UserId'].nunique()) if 'UserId' in df.columns else None,
+        'min_datetime': str(df['Datetime'].min()) if 'Datetime' in df.columns else None,
+        'max_datetime': str(df['Datetime'].max()) if 'Datetime' in df.columns else None,
+        'compacted_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    }
+    return df, stats, None
+
+
+# Функция для сериализации раздела в Parquet со статистикой в метаданных
+def partition_to_parquet(df, stats):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[STATS_METADATA_KEY] = json.dumps(stats, ensure_ascii=False).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+
+    sink = io.BytesIO()
+    pq.write_table(table, sink, compression='zstd', row_group_size=ROW_GROUP_SIZE, write_statistics=True)
+    return sink.getvalue()
+
+
+# Функция для сжатия периода
+def compact_range(s3_client, bucket_name, prefix, days, output_prefix=None, output_dir=None,
+                  overwrite=False, max_workers=DEFAULT_MAX_WORKERS):
+    """Пишет разделы закрытых дней в output_dir (локально) или в output_prefix (S3).
+    Возвращает (количество записанных разделов, список ошибок)"""
+    days = [day for day in days if is_day_closed(day)]
+    existing = set()
+    if not overwrite:
+        if output_dir is not None:
+            existing = {day for day in days if (Path(output_dir) / f"{day}.parquet").exists()}
+        else:
+            existing = set(list_compacted_days(s3_client, bucket_name, output_prefix, days))
+
+    written = 0
+    errors = []
+    for day in days:
+        if day in existing:
+            logger.info(f"Раздел {day} уже существует, пропускаем")
+            continue
+
+        df, stats, error = compact_day(s3_client, bucket_name, prefix, day, max_workers)
+        if error:
+            logger.error(error)
+            errors.append(error)
+            continue
+        if df is None:
+            logger.info(f"За {day} нет данных")
+            continue
+
+        try:
+            data = partition_to_parquet(df, stats)
+            if output_dir is not None:
+                path = Path(output_dir) / f"{day}.parquet"
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_name(f"{path.name}.tmp")
+                tmp_path.write_bytes(data)
+                tmp_path.replace(path)
+                target = str(path)
+            else:
+                target = compacted_key(output_prefix, day)
+                s3_client.put_object(Bucket=bucket_name, Key=target, Body=data)
+        except Exception as e:
+            error_message = f"Ошибка при записи раздела {day}: {str(e)}"
+            logger.error(error_message)
+            errors.append(error_message)
+            continue
+
+        written += 1
+        logger.info(
+            f"Раздел {day}: файлов {stats['files']}, строк {stats['rows']}, "
+            f"{len(data) / 1024 ** 2:,.2f} МБ -> {target}"
+        )
+
+    return written, errors
+
+
+# Функция для разбора аргументов командной строки
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Сжатие 5-минутных JSON-файлов закрытых дней в дневные Parquet-разделы'
+    )
+    parser.add_argument('--bucket', default='technicalgiftagram', help='Имя бакета S3')
+    parser.add_argument('--prefix', default='processed-logs/funds-log/5min/', help='Префикс 5-минутных файлов')
+    parser.add_argument('--output-prefix', help='Префикс разделов в том же бакете (по умолчанию соседний .../daily/)')
+    parser.add_argument('--output-dir', help='Писать разделы в локальный каталог вместо S3')
+    parser.add_argument('--start', type=date.fromisoformat, default=MIN_DATE, help='Первый день (YYYY-MM-DD)')
+    parser.add_argument(
+        '--end', type=date.fromisoformat,
+        help='Последний день (по умолчанию - сегодня по UTC); незакрытые дни пропускаются'
+    )
+    parser.add_argument('--overwrite', action='store_true', help='Пересобрать уже существующие разделы')
+    parser.add_argument('--max-workers', type=int, default=DEFAULT_MAX_WORKERS, help='Параллельных загрузок')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+
+    end = args.end or datetime.now(timezone.utc).date()
+    output_prefix = args.output_prefix or default_compacted_prefix(args.prefix)
+
+    # Ключи не передаются: boto3 использует стандартную цепочку учетных данных
+    s3_client, connection_error = connect_to_s3(None, None, args.max_workers)
+    if connection_error:
+        logger.error(connection_error)
+        return 1
+
+    written, errors = compact_range(
+        s3_client, args.bucket, args.prefix, days_in_range(args.start, end),
+        output_prefix=output_prefix, output_dir=args.output_dir,
+        overwrite=args.overwrite, max_workers=args.max_workers
+    )
+    logger.info(f"Записано разделов: {written}, ошибок: {len(errors)}")
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from explorer import build_user_index, merge_user_indexes, user_index_nbytes
+from retention import UserDictionary, build_day_bitmaps, day_bitmaps_nbytes, merge_day_bitmaps
+from rollups import merge_rollups, rollup_memory_usage
+from s3_source import DATE_PATTERN, advance_watermark, is_day_closed
+
+logger = logging.getLogger('gift-dashboard')
+
+# Лимит памяти дневных разделов по умолчанию (МБ)
+DEFAULT_MEMORY_LIMIT_MB = 2048
+
+# Сколько собранных агрегатов периодов держать (разные сессии смотрят разные периоды)
+COMBINED_CACHE_SIZE = 4
+
+
+class DatasetStore:
+    """Общее для всех сессий хранилище дневных разделов одного бакета и префикса.
+
+    Раздел: {'rollup', 'files', 'user_index', 'last_key', 'failed', 'closed', 'fingerprint', 'bitmaps'};
+    разделы только заменяются целиком, поэтому сессии читают их без копирования. Загрузку дня выполняет
+    одна сессия (single-flight), остальные ждут ее завершения. Лимит памяти включает собранные агрегаты
+    периодов: при превышении сначала вытесняются они (их можно собрать заново), затем давно не использованные дни.
+    """
+
+    def __init__(self, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+        self.lock = threading.Lock()
+        self.memory_limit = memory_limit_mb * 1024 ** 2
+        # День -> раздел, в порядке последнего использования
+        self.partitions = OrderedDict()
+        self.partition_memory = {}
+        # День -> событие окончания загрузки, которую выполняет одна из сессий
+        self.inflight = {}
+        # Ключ набора разделов -> объединенный агрегат и занимаемая им память
+        self.combined = OrderedDict()
+        self.combined_memory = {}
+        # Время последней публикации разделов (UTC)
+        self.published_at = None
+        # Словарь пользователей: коды битовых карт активности одинаковы во всех разделах
+        self.users = UserDictionary()
+
+    # Метод для изменения лимита памяти (в МБ)
+    def set_memory_limit(self, memory_limit_mb):
+        with self.lock:
+            if self.memory_limit != memory_limit_mb * 1024 ** 2:
+                self.memory_limit = memory_limit_mb * 1024 ** 2
+                self._evict()
+
+    # Метод для получения загруженных разделов дней
+    def get_partitions(self, days, touch=True):
+        """touch - отметить дни как использованные (фоновая догрузка их не отмечает)"""
+        with self.lock:
+            partitions = {}
+            for day in days:
+                if day in self.partitions:
+                    if touch:
+                        self.partitions.move_to_end(day)
+                    partitions[day] = self.partitions[day]
+            return partitions
+
+    # Метод для получения загруженных дней, в которые еще могут прийти файлы
+    def open_days(self):
+        with self.lock:
+            return [day for day, partition in self.partitions.items() if not partition['closed']]
+
+    # Метод для захвата загрузки дней
+    def claim(self, days):
+        """Возвращает (дни, которые загружает вызывающий, события загрузок других сессий для ожидания)"""
+        with self.lock:
+            claimed, waiting = [], []
+            for day in days:
+                if day in self.inflight:
+                    waiting.append(self.inflight[day])
+                else:
+                    self.inflight[day] = threading.Event()
+                    claimed.append(day)
+            return claimed, waiting
+
+    # Метод для завершения загрузки дней (в том числе неудачной)
+    def release(self, days):
+        with self.lock:
+            for day in days:
+                event = self.inflight.pop(day, None)
+                if event is not None:
+                    event.set()
+
+    # Метод для публикации разделов: все дни заменяются разом, сессии видят либо старую, либо новую версию
+    def publish(self, partitions, pinned=()):
+        """partitions - {день: раздел}; pinned - дни, которые не вытесняются (например, период, запрошенный сессией)"""
+        # Битовые карты активных и платящих пользователей строятся при публикации раздела
+        # и переиспользуются, пока агрегат дня не изменился
+        current = self.get_partitions(partitions, touch=False)
+        for day, partition in partitions.items():
+            if day in current and current[day]['rollup'] is partition['rollup'] and 'bitmaps' in current[day]:
+                partition['bitmaps'] = current[day]['bitmaps']
+            else:
+                partition['bitmaps'] = build_day_bitmaps(partition['rollup'], self.users)
+        memory = {
+            day: rollup_memory_usage(partition['rollup']) + day_bitmaps_nbytes(partition['bitmaps'])
+            + user_index_nbytes(partition.get('user_index'))
+            for day, partition in partitions.items()
+        }
+        with self.lock:
+            for day, partition in partitions.items():
+                self.partitions[day] = partition
+                self.partitions.move_to_end(day)
+                self.partition_memory[day] = memory[day]
+            self.published_at = datetime.now(timezone.utc)
+            self._evict(set(pinned) | set(partitions))
+
+    # Метод для вытеснения агрегатов периодов и давно не использованных разделов сверх лимита памяти (под блокировкой)
+    def _evict(self, pinned=frozenset(), keep_combined=None):
+        for combined_key in list(self.combined):
+            if self.memory_usage() <= self.memory_limit:
+                return
+            if combined_key != keep_combined:
+                del self.combined[combined_key]
+                del self.combined_memory[combined_key]
+
+        for day in list(self.partitions):
+            if self.memory_usage() <= self.memory_limit:
+                return
+            if day in pinned or day in self.inflight:
+                continue
+            del self.partitions[day]
+            del self.partition_memory[day]
+            logger.info(f"Раздел {day} вытеснен из памяти (лимит {self.memory_limit / 1024 ** 2:,.0f} МБ)")
+
+        if self.memory_usage() > self.memory_limit:
+            logger.warning(
+                f"Запрошенный период занимает {self.memory_usage() / 1024 ** 2:,.1f} МБ - больше лимита памяти"
+            )
+
+    # Метод для подсчета памяти разделов, агрегатов периодов и словаря пользователей (в байтах)
+    def memory_usage(self):
+        return sum(self.partition_memory.values()) + sum(self.combined_memory.values()) + self.users.nbytes()
+
+    # Метод для получения битовых карт активных и платящих пользователей по дням периода
+    def day_bitmaps(self, days):
+        partitions = self.get_partitions(days)
+        return merge_day_bitmaps([partitions[day].get('bitmaps', {}) for day in days if day in partitions])
+
+    # Метод для получения объединенного агрегата периода
+    def combined_rollup(self, days):
+        """Возвращает (версия набора данных, агрегат или None); агрегат общий для сессий с тем же набором разделов"""
+        partitions = {
+            day: partition for day, partition in self.get_partitions(days).items() if partition['rollup'] is not None
+        }
+        combined_key = tuple((day, partitions[day]['fingerprint']) for day in days if day in partitions)
+        # Одинаковые файлы с одинаковыми ETag дают одинаковую версию - кэш метрик общий для сессий
+        version = hashlib.sha1(repr(combined_key).encode('utf-8')).hexdigest()
+
+        with self.lock:
+            if combined_key in self.combined:
+                self.combined.move_to_end(combined_key)
+                return version, self.combined[combined_key]
+
+        rollup = merge_rollups([partitions[day]['rollup'] for day, _ in combined_key])
+        # Агрегат одного дня - это агрегат раздела, отдельной памяти он не занимает
+        memory = rollup_memory_usage(rollup) if len(combined_key) > 1 else 0
+        with self.lock:
+            self.combined[combined_key] = rollup
+            self.combined_memory[combined_key] = memory
+            while len(self.combined) > COMBINED_CACHE_SIZE:
+                del self.combined_memory[self.combined.popitem(last=False)[0]]
+            self._evict(set(partitions), keep_combined=combined_key)
+        return version, rollup
+
+
+# Функция для построения новых разделов дней из загруженных файлов
+def build_partitions(days, partitions, file_list, loaded_rollups, ok_keys):
+    """partitions - текущие разделы дней (новые дни в них отсутствуют), file_list - найденные файлы,
+    loaded_rollups - агрегаты загруженных файлов, ok_keys - успешно обработанные ключи (остальные файлы
+    списка попадают в 'failed' раздела и повторяются при следующем обновлении).
+    Возвращает {день: новый раздел}"""
+    # Раскладываем файлы по дневным разделам
+    files_by_day = {}
+    for file_obj in file_list:
+        files_by_day.setdefault(DATE_PATTERN.search(file_obj['Key']).group(1), []).append(file_obj)
+
+    updated = {}
+    for day in days:
+        day_files = sorted(files_by_day.get(day, []), key=lambda obj: obj['Key'])
+        partition = partitions.get(day, {'rollup': None, 'files': [], 'last_key': None})
+
+        # Берем все загруженные файлы; файлы с ошибками не задерживают остальные, а повторяются по ключам
+        last_key, failed = advance_watermark(day_files, ok_keys, partition['last_key'])
+        new_files = [file_obj for file_obj in day_files if file_obj['Key'] in loaded_rollups]
+
+        rollup = partition['rollup']
+        user_index = partition.get('user_index')
+        if new_files:
+            new_rollups = [loaded_rollups[file_obj['Key']] for file_obj in new_files]
+            rollup = merge_rollups([rollup] + new_rollups)
+            # Индекс пользователей (хеш UserId -> позиции файлов раздела) для поиска сырых строк пользователя
+            user_index = merge_user_indexes([user_index, build_user_index(new_rollups, len(partition['files']))])
+
+        # Отпечаток раздела: цепочка хешей по ключам и ETag вошедших в него файлов
+        fingerprint = partition.get('fingerprint', '')
+        for file_obj in new_files:
+            fingerprint = hashlib.sha1(
+                f"{fingerprint}|{file_obj['Key']}|{file_obj.get('ETag')}".encode('utf-8')
+            ).hexdigest()
+
+        updated[day] = {
+            'rollup': rollup,
+            # Загруженные файлы (в том числе пустые): по ним сырые данные читаются из кэша по запросу
+            'files': partition['files'] + [{'Key': obj['Key'], 'ETag': obj.get('ETag')} for obj in new_files],
+            'user_index': user_index,
+            'last_key': last_key,
+            'failed': failed,
+            'closed': not failed and is_day_closed(day),
+            'fingerprint': fingerprint
+        }
+
+    return updated
@@ -0,0 +1,144 @@
+import json
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# Этапы пути загрузки (в порядке выполнения) - для сортировки в панели диагностики
+LOAD_STAGES = [
+    'list', 'cache_read', 'fetch', 'decompress', 'decode', 'parse', 'normalize',
+    'cache_write', 'rollup', 'concat', 'merge',
+]
+
+# Префикс этапов расчета метрик
+METRIC_STAGE_PREFIX = 'metric:'
+
+# Сколько последних событий по файлам хранить для выгрузки в JSONL
+MAX_EVENTS = 10_000
+
+
+# Класс для сбора времени этапов и счетчиков (общий для потоков процесса)
+class Diagnostics:
+    def __init__(self, max_events=MAX_EVENTS):
+        self.lock = threading.Lock()
+        self.max_events = max_events
+        self.reset()
+
+    # Метод для сброса накопленной статистики
+    def reset(self):
+        with self.lock:
+            # {этап: {'calls', 'errors', 'seconds', 'max_seconds', 'bytes', 'rows'}}
+            self.stages = {}
+            # Счетчики: попадания/промахи кэша, отброшенные строки TestMode, битые строки и т.п.
+            self.counters = Counter()
+            self.events = deque(maxlen=self.max_events)
+            self.started_at = datetime.now(timezone.utc)
+
+    # Метод для записи одного выполнения этапа
+    def record(self, stage, seconds, size_bytes=0, rows=0, error=False, **fields):
+        with self.lock:
+            stats = self.stages.setdefault(
+                stage, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0, 'rows': 0}
+            )
+            stats['calls'] += 1
+            stats['errors'] += bool(error)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += size_bytes
+            stats['rows'] += rows
+            self.events.append({
+                'ts': time.time(), 'stage': stage, 'seconds': round(seconds, 6),
+                'bytes': size_bytes, 'rows': rows, 'error': bool(error), **fields,
+            })
+
+    # Метод для пересоздания блокировки в дочернем процессе после fork: если при fork ее держал
+    # другой поток родителя, в дочернем процессе она не освободилась бы никогда
+    def reinit_after_fork(self):
+        self.lock = threading.Lock()
+
+    # Метод для увеличения счетчика
+    def count(self, name, value=1):
+        if value:
+            with self.lock:
+                self.counters[name] += int(value)
+
+    # Метод для получения накопленных итогов (без событий)
+    def snapshot(self):
+        with self.lock:
+            return {
+                'stages': {stage: dict(stats) for stage, stats in self.stages.items()},
+                'counters': dict(self.counters),
+            }
+
+    # Метод для добавления итогов, собранных в другом процессе (пул разбора)
+    def merge(self, snapshot):
+        with self.lock:
+            for stage, other in snapshot.get('stages', {}).items():
+                stats = self.stages.setdefault(
+                    stage, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes': 0, 'rows': 0}
+                )
+                for name in ('calls', 'errors', 'seconds', 'bytes', 'rows'):
+                    stats[name] += other[name]
+                stats['max_seconds'] = max(stats['max_seconds'], other['max_seconds'])
+            self.counters.update(snapshot.get('counters', {}))
+
+    # Метод для получения таблицы этапов для панели диагностики
+    def stage_table(self):
+        stages = self.snapshot()['stages']
+        if not stages:
+            return pd.DataFrame()
+        order = {stage: i for i, stage in enumerate(LOAD_STAGES)}
+        rows = []
+        for stage in sorted(stages, key=lambda stage: (order.get(stage, len(order)), stage)):
+            stats = stages[stage]
+            rows.append({
+                'Этап': stage,
+                'Вызовов': stats['calls'],
+                'Ошибок': stats['errors'],
+                'Всего, с': round(stats['seconds'], 3),
+                'Среднее, мс': round(stats['seconds'] / stats['calls'] * 1000, 2),
+                'Макс., мс': round(stats['max_seconds'] * 1000, 2),
+                'МБ': round(stats['bytes'] / 1024 ** 2, 2),
+                'Строк': stats['rows'],
+            })
+        return pd.DataFrame(rows)
+
+    # Метод для выгрузки итогов и последних событий в формате JSON Lines
+    def to_jsonl(self):
+        snapshot = self.snapshot()
+        with self.lock:
+            events = list(self.events)
+        lines = [{'type': 'summary', 'started_at': self.started_at.isoformat(timespec='seconds'), **snapshot}]
+        lines += [{'type': 'event', **event} for event in events]
+        return '\n'.join(json.dumps(line, ensure_ascii=False, default=str) for line in lines) + '\n'
+
+
+# Общий сборщик процесса: этапы выполняются в потоках пулов, поэтому он не привязан к сессии
+DIAGNOSTICS = Diagnostics()
+
+
+# Функция для замера этапа: в блоке можно заполнить info['bytes'], info['rows'] и info['error']
+# (ошибка, возвращенная, а не выброшенная)
+@contextmanager
+def timed(stage, **fields):
+    info = {'bytes': 0, 'rows': 0, 'error': False}
+    started = time.perf_counter()
+    error = False
+    try:
+        yield info
+    except BaseException:
+        error = True
+        raise
+    finally:
+        DIAGNOSTICS.record(
+            stage, time.perf_counter() - started, size_bytes=info['bytes'], rows=info['rows'],
+            error=error or bool(info['error']), **fields
+        )
+
+
+# Функция для увеличения счетчика общего сборщика
+def count(name, value=1):
+    DIAGNOSTICS.count(name, value)
@@ -0,0 +1,125 @@
+import logging
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from diagnostics import METRIC_STAGE_PREFIX, timed
+from metrics import SPIN_DEPTH, spin_table
+
+# DuckDB - необязательная зависимость: без нее метрики считаются по агрегатам в памяти (pandas)
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+logger = logging.getLogger('gift-dashboard')
+
+# Лимит памяти DuckDB: при превышении промежуточные результаты сбрасываются на диск
+DUCKDB_MEMORY_LIMIT = os.environ.get('GIFT_DASHBOARD_DUCKDB_MEMORY', '2GB')
+
+
+# Функция для проверки, доступен ли движок DuckDB
+def duckdb_available():
+    return duckdb is not None
+
+
+# Функция для подключения к DuckDB с видом tx над Parquet-файлами
+def connect_parquet(paths, start_day, end_day):
+    """Вид tx читает только нужные колонки (projection pushdown) и строки периода (predicate pushdown
+    по статистике групп строк); файлы сканируются параллельно во всех потоках"""
+    con = duckdb.connect(config={
+        'threads': os.cpu_count() or 1,
+        'memory_limit': DUCKDB_MEMORY_LIMIT,
+    })
+    # Разные файлы могут отличаться набором колонок - объединяем по именам
+    con.read_parquet(list(paths), union_by_name=True).create_view('raw')
+
+    # Границы периода - только даты ISO, проверенные date.fromisoformat
+    period_start = date.fromisoformat(start_day).isoformat()
+    period_end = (date.fromisoformat(end_day) + timedelta(days=1)).isoformat()
+    con.execute(f"""
+        CREATE TEMP VIEW tx AS
+        SELECT
+            UserId,
+            InvoiceType = 1 AS paid,
+            TRY_CAST(Amount AS DOUBLE) AS Amount,
+            Date
+        FROM raw
+        WHERE (Date >= TIMESTAMP '{period_start}' AND Date < TIMESTAMP '{period_end}') OR Date IS NULL
+    """)
+    return con
+
+
+# Функция для расчета метрик дашборда SQL-запросами по Parquet-файлам на диске
+def compute_parquet_metrics(paths, start_day, end_day, spin_depth=SPIN_DEPTH):
+    """Возвращает словарь метрик в формате compute_rollup_metrics (см. metrics.py).
+    Строки не загружаются в pandas: в память попадают только результаты агрегаций.
+
+    Это другой путь расчета тех же метрик (например, для сверки), а не экономия памяти дашборда:
+    дневные агрегаты и агрегат периода строятся при загрузке в любом случае, на них работают
+    остальные разделы дашборда (удержание, тепловые карты, сегменты воронки)"""
+    with timed(f"{METRIC_STAGE_PREFIX}duckdb", files=len(paths)) as info:
+        info['bytes'] = sum(os.path.getsize(path) for path in paths)
+        return query_parquet_metrics(paths, start_day, end_day, spin_depth)
+
+
+# Функция для выполнения SQL-запросов метрик по Parquet-файлам
+def query_parquet_metrics(paths, start_day, end_day, spin_depth=SPIN_DEPTH):
+    con = connect_parquet(paths, start_day, end_day)
+    try:
+        # Количество оплат на пользователя за период
+        con.execute("""
+            CREATE TEMP TABLE user_payments AS
+            SELECT UserId, count_if(paid) AS paid_count
+            FROM tx
+            WHERE UserId IS NOT NULL
+            GROUP BY UserId
+        """)
+        total_users, paying_users = con.execute(
+            "SELECT count(*), count_if(paid_count > 0) FROM user_payments"
+        ).fetchone()
+
+        # Гистограмма оплат, обрезанная до глубины воронки; до каждого спина доходят пользователи
+        # с не меньшим числом оплат - обратная накопленная сумма
+        histogram = np.zeros(spin_depth + 1, dtype=np.int64)
+        for paid_count, users in con.execute(
+            "SELECT least(paid_count, ?) AS spins, count(*) FROM user_payments GROUP BY spins", [spin_depth]
+        ).fetchall():
+            histogram[paid_count] = users
+        users_with_spins = histogram[::-1].cumsum()[::-1][1:]
+
+        daily = con.execute("""
+            SELECT
+                Date,
+                count(DISTINCT UserId) AS users,
+                count(DISTINCT UserId) FILTER (WHERE paid) AS paying_users
+            FROM tx
+            WHERE UserId IS NOT NULL AND Date IS NOT NULL
+            GROUP BY Date
+            ORDER BY Date
+        """).df()
+
+        total_deposits = con.execute("SELECT coalesce(sum(Amount) FILTER (WHERE paid), 0) FROM tx").fetchone()[0]
+    finally:
+        con.close()
+
+    daily['Date'] = pd.to_datetime(daily['Date'])
+    users_daily = daily[['Date', 'users']].rename(columns={'users': 'Уникальные пользователи'})
+    paying_users_daily = (
+        daily.loc[daily['paying_users'] > 0, ['Date', 'paying_users']]
+        .rename(columns={'paying_users': 'Платящие пользователи'})
+        .reset_index(drop=True)
+    )
+
+    return {
+        'total_users': int(total_users),
+        'paying_users': int(paying_users),
+        'total_deposits': float(total_deposits),
+        'users_daily': users_daily,
+        'paying_users_daily': paying_users_daily,
+        'spin_conversion': spin_table(users_with_spins, int(total_users)),
+        'approximate': False,
+        'relative_error': None,
+    }
@@ -0,0 +1,179 @@
+import numpy as np
+import pandas as pd
+
+from hll import hash_user_ids
+from s3_source import COMPACTED_SUFFIX
+from schema import concat_frames
+
+# Строк на странице просмотра сырых данных
+PAGE_SIZE = 50
+
+
+# Функция для построения индекса пользователей по файлам дня
+def build_user_index(file_rollups, first_position=0):
+    """file_rollups - агрегаты файлов в порядке partition['files'], начиная с позиции first_position.
+    Возвращает {'hashes': отсортированные хеши UserId, 'files': позиции файлов, где встречается пользователь}"""
+    hashes = []
+    positions = []
+    for position, rollup in enumerate(file_rollups, start=first_position):
+        if rollup is None or rollup['user_days'].empty:
+            continue
+        # В user_days пользователи файла уже собраны (в том числе со строками без InvoiceType) - строки файла не нужны
+        file_hashes = np.unique(hash_user_ids(rollup['user_days']['UserId']))
+        if not file_hashes.size:
+            continue
+        hashes.append(file_hashes)
+        positions.append(np.full(file_hashes.size, position, dtype=np.int32))
+
+    if not hashes:
+        return None
+    return sort_user_index(np.concatenate(hashes), np.concatenate(positions))
+
+
+# Функция для сортировки индекса по хешу (при равных хешах - по позиции файла)
+def sort_user_index(hashes, positions):
+    order = np.lexsort((positions, hashes))
+    return {'hashes': hashes[order], 'files': positions[order]}
+
+
+# Функция для объединения индексов (раздел дня дополняется новыми файлами)
+def merge_user_indexes(indexes):
+    indexes = [index for index in indexes if index is not None]
+    if not indexes:
+        return None
+    if len(indexes) == 1:
+        return indexes[0]
+    return sort_user_index(
+        np.concatenate([index['hashes'] for index in indexes]),
+        np.concatenate([index['files'] for index in indexes])
+    )
+
+
+# Функция для подсчета памяти индекса (в байтах)
+def user_index_nbytes(index):
+    if index is None:
+        return 0
+    return int(index['hashes'].nbytes + index['files'].nbytes)
+
+
+# Функция для получения хешей введенного идентификатора пользователя
+def user_id_hashes(user_id):
+    """В файлах UserId может быть и числом, и строкой - ищем оба варианта"""
+    user_id = str(user_id).strip()
+    candidates = [user_id]
+    try:
+        candidates.append(int(user_id))
+    except ValueError:
+        pass
+    return np.unique(np.concatenate([hash_user_ids(pd.Series([candidate])) for candidate in candidates]))
+
+
+# Функция для поиска файлов пользователя по индексу (бинарный поиск, O(log n))
+def user_file_positions(index, hashes):
+    if index is None:
+        return np.empty(0, dtype=np.int32)
+    left = np.searchsorted(index['hashes'], hashes, side='left')
+    right = np.searchsorted(index['hashes'], hashes, side='right')
+    return np.unique(np.concatenate([index['files'][lo:hi] for lo, hi in zip(left, right)]))
+
+
+# Функция для получения файлов, которые могут содержать строки по фильтрам
+def candidate_files(partitions, days, filters):
+    """Дни сужаются по диапазону дат, файлы - по индексу пользователей и подстроке ключа (кроме сжатых дней)"""
+    user_hashes = user_id_hashes(filters['user_id']) if filters.get('user_id') else None
+    date_from = filters.get('date_from')
+    date_to = filters.get('date_to')
+
+    candidates = []
+    for day in days:
+        if day not in partitions:
+            continue
+        if (date_from and day < date_from.isoformat()) or (date_to and day > date_to.isoformat()):
+            continue
+        files = partitions[day]['files']
+        if user_hashes is not None:
+            files = [files[position] for position in user_file_positions(partitions[day].get('user_index'), user_hashes)]
+        if filters.get('file'):
+            # Сжатый день - один файл раздела: исходные файлы ищутся по колонке file_name его строк
+            files = [
+                file_obj for file_obj in files
+                if filters['file'] in file_obj['Key'] or file_obj['Key'].endswith(COMPACTED_SUFFIX)
+            ]
+        candidates.extend(files)
+    return candidates
+
+
+# Функция для отбора строк файла по фильтрам
+def filter_rows(df, filters):
+    mask = np.ones(len(df), dtype=bool)
+
+    if filters.get('user_id'):
+        known = df['UserId'].notna().to_numpy()
+        hashes = np.zeros(len(df), dtype=np.uint64)
+        hashes[known] = hash_user_ids(df['UserId'][known])
+        mask &= known & np.isin(hashes, user_id_hashes(filters['user_id']))
+
+    if filters.get('file') and 'file_name' in df.columns:
+        mask &= df['file_name'].astype(str).str.contains(filters['file'], regex=False).to_numpy()
+
+    if 'Date' in df.columns:
+        # Строки без даты отбрасываются только при явном ограничении периода
+        dates = df['Date']
+        if filters.get('date_from'):
+            mask &= (dates >= pd.Timestamp(filters['date_from'])).to_numpy()
+        if filters.get('date_to'):
+            mask &= (dates < pd.Timestamp(filters['date_to']) + pd.Timedelta(days=1)).to_numpy()
+
+    if filters.get('invoice_types'):
+        mask &= df['InvoiceType'].isin(filters['invoice_types']).to_numpy()
+
+    if filters.get('amount_min') is not None or filters.get('amount_max') is not None:
+        amount = pd.to_numeric(df['Amount'], errors='coerce')
+        if filters.get('amount_min') is not None:
+            mask &= (amount >= filters['amount_min']).to_numpy()
+        if filters.get('amount_max') is not None:
+            mask &= (amount <= filters['amount_max']).to_numpy()
+
+    return df[mask]
+
+
+# Функция для получения страницы сырых транзакций
+def explore_transactions(partitions, days, load_frame, filters, cursor=None, page_size=PAGE_SIZE):
+    """load_frame(объект файла) -> DataFrame файла (из локального кэша); cursor - (ключ файла, строка) начала
+    страницы или None для первой. Курсор по ключу остается верным, пока к разделам добавляются новые файлы;
+    если файла курсора больше нет среди кандидатов (день сжат), выбрасывается LookupError.
+
+    Файлы читаются по порядку только до заполнения страницы. Возвращает
+    (строки страницы или None, курсор следующей страницы или None, количество файлов-кандидатов, прочитано файлов)"""
+    candidates = candidate_files(partitions, days, filters)
+    file_number, row_offset = 0, 0
+    if cursor is not None:
+        keys = [file_obj['Key'] for file_obj in candidates]
+        if cursor[0] not in keys:
+            raise LookupError(cursor[0])
+        file_number, row_offset = keys.index(cursor[0]), cursor[1]
+    frames = []
+    remaining = page_size
+    files_read = 0
+
+    for number in range(file_number, len(candidates)):
+        df = load_frame(candidates[number])
+        files_read += 1
+        if df is None:
+            continue
+        rows = filter_rows(df, filters)
+        start = row_offset if number == file_number else 0
+        page_rows = rows.iloc[start:start + remaining]
+        frames.append(page_rows)
+        remaining -= len(page_rows)
+        if remaining == 0:
+            end = start + len(page_rows)
+            if end < len(rows):
+                next_cursor = (candidates[number]['Key'], end)
+            elif number + 1 < len(candidates):
+                next_cursor = (candidates[number + 1]['Key'], 0)
+            else:
+                next_cursor = None
+            return concat_frames(frames), next_cursor, len(candidates), files_read
+
+    return concat_frames(frames), None, len(candidates), files_read
@@ -0,0 +1,187 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Точность по умолчанию: 2^14 регистров (16 КБ), стандартная ошибка ≈ 0.8%
+DEFAULT_PRECISION = 14
+MIN_PRECISION = 4
+MAX_PRECISION = 16
+
+
+# Функция для получения 64-битных хешей идентификаторов пользователей
+def hash_user_ids(user_ids):
+    """Хеширует идентификаторы без пропусков. Целые значения, пришедшие как float, хешируются как int,
+    чтобы один пользователь давал один хеш во всех файлах"""
+    values = pd.Series(user_ids).dropna()
+    if values.empty:
+        return np.empty(0, dtype=np.uint64)
+
+    # Для категорий хешируем словарь и раскладываем хеши по кодам
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        category_hashes = hash_user_ids(pd.Series(values.cat.categories))
+        return category_hashes[values.cat.codes.to_numpy()]
+
+    if pd.api.types.is_float_dtype(values.dtype) and (values % 1 == 0).all():
+        values = values.astype('int64')
+
+    if pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+        return pd.util.hash_array(values.to_numpy())
+    return pd.util.hash_array(values.astype(str).to_numpy(dtype=object))
+
+
+# Функция для подсчета ведущих нулей в 64-битных числах (векторно)
+def leading_zeros64(values):
+    values = values.astype(np.uint64, copy=True)
+    zeros = np.zeros(values.shape, dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        # У числа нет единиц в старших shift битах
+        mask = values < (np.uint64(1) << np.uint64(64 - shift))
+        zeros[mask] += shift
+        values[mask] <<= np.uint64(shift)
+    zeros[values == 0] = 64
+    return zeros
+
+
+# Функция для получения номеров регистров и рангов для 64-битных хешей
+def register_updates(hashes, precision):
+    """Возвращает (номер регистра, ранг): регистр берет максимум рангов попавших в него хешей"""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    p = np.uint64(precision)
+    index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+    # Ранг - позиция первой единицы в оставшихся 64 - p битах
+    rank = np.minimum(leading_zeros64(hashes << p) + 1, 64 - precision + 1).astype(np.uint8)
+    return index, rank
+
+
+# Функция для оценки количества уникальных значений по регистрам (векторно по последней оси)
+def estimate_cardinality(registers):
+    """registers - массив формы (..., 2^p); возвращает массив оценок формы (...)"""
+    m = registers.shape[-1]
+    if m == 16:
+        alpha = 0.673
+    elif m == 32:
+        alpha = 0.697
+    elif m == 64:
+        alpha = 0.709
+    else:
+        alpha = 0.7213 / (1 + 1.079 / m)
+
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)), axis=-1)
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+    # Поправка для малых значений (linear counting)
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.where((estimate <= 2.5 * m) & (zeros > 0), linear, estimate)
+
+
+class HyperLogLog:
+    """Скетч HyperLogLog для приближенного подсчета уникальных значений.
+
+    Скетчи с одинаковой точностью объединяются поэлементным максимумом регистров,
+    скетч можно понизить до меньшей точности (fold) без исходных данных.
+
+    Пока занятых регистров мало (скетч одного файла), хранятся только пары (номер регистра, ранг) -
+    3 байта на регистр вместо 2^p байт на скетч; при заполнении скетч переходит в плотную форму.
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None, sparse=None):
+        if not MIN_PRECISION <= precision <= MAX_PRECISION:
+            raise ValueError(f"Точность HyperLogLog должна быть от {MIN_PRECISION} до {MAX_PRECISION}")
+        self.precision = precision
+        self.registers = registers
+        # Разреженная форма: (отсортированные номера регистров uint16, ранги uint8); None - плотная форма
+        self.sparse = None
+        if registers is None:
+            self._set_sparse(*(sparse or (np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint8))))
+
+    # Метод для сохранения разреженных пар (максимум ранга по регистру) с переходом в плотную форму
+    def _set_sparse(self, index, rank):
+        order = np.argsort(index, kind='stable')
+        index, rank = index[order], rank[order]
+        if index.size:
+            starts = np.flatnonzero(np.r_[True, index[1:] != index[:-1]])
+            index, rank = index[starts], np.maximum.reduceat(rank, starts)
+        # Пара занимает 3 байта: при заполнении больше трети регистров плотная форма меньше
+        if index.size * 3 >= (1 << self.precision):
+            self.registers = np.zeros(1 << self.precision, dtype=np.uint8)
+            self.registers[index] = rank
+            self.sparse = None
+        else:
+            self.sparse = (index.astype(np.uint16), rank.astype(np.uint8))
+
+    # Метод для получения плотного массива регистров (в разреженной форме - копия)
+    def dense_registers(self):
+        if self.sparse is None:
+            return self.registers
+        registers = np.zeros(1 << self.precision, dtype=np.uint8)
+        registers[self.sparse[0]] = self.sparse[1]
+        return registers
+
+    # Метод для добавления 64-битных хешей
+    def add_hashes(self, hashes):
+        if len(hashes) == 0:
+            return self
+        index, rank = register_updates(hashes, self.precision)
+        if self.sparse is None:
+            np.maximum.at(self.registers, index, rank)
+        else:
+            self._set_sparse(np.r_[self.sparse[0], index], np.r_[self.sparse[1], rank])
+        return self
+
+    # Метод для понижения точности (объединение соседних регистров)
+    def fold(self, precision):
+        if precision == self.precision:
+            return self
+        if precision > self.precision:
+            raise ValueError("Нельзя повысить точность скетча HyperLogLog")
+
+        shift = self.precision - precision
+        registers = self.dense_registers()
+        index = np.arange(registers.size)
+        # Младшие биты старого индекса становятся старшими битами остатка хеша
+        low_bits = (index & ((1 << shift) - 1)).astype(np.uint64)
+        low_rank = leading_zeros64(low_bits << np.uint64(64 - shift)) + 1
+        rank = np.where(
+            registers == 0,
+            0,
+            np.where(low_bits != 0, low_rank, shift + registers.astype(np.int64))
+        ).astype(np.uint8)
+
+        folded = np.zeros(1 << precision, dtype=np.uint8)
+        np.maximum.at(folded, index >> shift, rank)
+        return HyperLogLog(precision, folded)
+
+    # Метод для объединения со скетчем (возвращает новый скетч)
+    def merge(self, other):
+        precision = min(self.precision, other.precision)
+        left, right = self.fold(precision), other.fold(precision)
+        if left.sparse is not None and right.sparse is not None:
+            return HyperLogLog(
+                precision, sparse=(np.r_[left.sparse[0], right.sparse[0]], np.r_[left.sparse[1], right.sparse[1]])
+            )
+        return HyperLogLog(precision, np.maximum(left.dense_registers(), right.dense_registers()))
+
+    # Метод для оценки количества уникальных значений
+    def count(self):
+        return int(round(float(estimate_cardinality(self.dense_registers()))))
+
+    # Метод для получения относительной стандартной ошибки
+    def relative_error(self):
+        return 1.04 / math.sqrt(1 << self.precision)
+
+    # Метод для получения размера скетча в байтах
+    def nbytes(self):
+        if self.sparse is not None:
+            return int(self.sparse[0].nbytes + self.sparse[1].nbytes)
+        return int(self.registers.nbytes)
+
+
+# Функция для объединения списка скетчей
+def merge_sketches(sketches):
+    sketches = [sketch for sketch in sketches if sketch is not None]
+    if not sketches:
+        return None
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged = merged.merge(sketch)
+    return merged
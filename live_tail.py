@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from dataset_store import build_partitions
+from s3_source import DEFAULT_MAX_WORKERS, list_new_files, load_files_concurrently
+
+logger = logging.getLogger('gift-dashboard')
+
+# Как часто проверять появление новых файлов (файлы пишутся раз в 5 минут)
+POLL_INTERVAL_SECONDS = 60
+
+# Сколько интервалов проверки ждать отметки сессии, прежде чем считать ее закрытой (вкладку закрыли)
+SESSION_TIMEOUT_INTERVALS = 3
+
+
+# Функция для получения дней, в которые фоновая загрузка ищет новые файлы
+def tail_days(store):
+    """Незакрытые загруженные дни и сегодняшний день (UTC), если загружен вчерашний"""
+    days = store.open_days()
+    today = datetime.now(timezone.utc).date()
+    yesterday = (today - timedelta(days=1)).isoformat()
+    if today.isoformat() not in days and store.get_partitions([yesterday], touch=False):
+        days.append(today.isoformat())
+    return days
+
+
+# Функция для одной проверки новых файлов и их публикации в хранилище
+def poll_once(store, s3_client, bucket_name, prefix, max_workers=DEFAULT_MAX_WORKERS, parse_pool=None,
+              compacted_prefix=None):
+    """Возвращает количество найденных новых файлов"""
+    # Дни, которые сейчас загружает какая-либо сессия, пропускаем до следующей проверки
+    claimed_days, _ = store.claim(tail_days(store))
+    try:
+        if not claimed_days:
+            return 0
+
+        partitions = store.get_partitions(claimed_days, touch=False)
+        missing_days = [day for day in claimed_days if day not in partitions]
+        open_days = {
+            day: (partitions[day]['last_key'], partitions[day]['failed']) for day in claimed_days if day in partitions
+        }
+
+        file_list, file_error = list_new_files(
+            s3_client, bucket_name, prefix, missing_days, open_days, compacted_prefix
+        )
+        if file_error or not file_list:
+            return 0
+
+        loaded_rollups = {}
+        ok_keys = set()
+        for _, file_key, rollup, error, _ in load_files_concurrently(
+            s3_client, bucket_name, file_list, max_workers, parse_pool
+        ):
+            if error:
+                continue
+            ok_keys.add(file_key)
+            if rollup is not None:
+                loaded_rollups[file_key] = rollup
+
+        store.publish(build_partitions(claimed_days, partitions, file_list, loaded_rollups, ok_keys))
+        logger.info(f"Фоновая загрузка: новых файлов {len(ok_keys)} из {len(file_list)}")
+        return len(file_list)
+    finally:
+        store.release(claimed_days)
+
+
+# Функция для подключения сессии к фоновой загрузке (и отметки, что сессия еще активна)
+def join_live_tail(tail, session_id):
+    """Возвращает False, если поток уже остановлен - тогда нужен новый"""
+    with tail['lock']:
+        if tail['stop'].is_set():
+            return False
+        tail['sessions'][session_id] = time.monotonic()
+        return True
+
+
+# Функция для отключения сессии от фоновой загрузки (поток останавливается, когда сессий не осталось)
+def leave_live_tail(tail, session_id):
+    with tail['lock']:
+        tail['sessions'].pop(session_id, None)
+        if not tail['sessions']:
+            tail['stop'].set()
+
+
+# Функция цикла фоновой загрузки (выполняется в отдельном потоке)
+def run_live_tail(tail, store, bucket_name, prefix):
+    while not tail['stop'].wait(tail['interval']):
+        # Сессии, давно не отмечавшиеся, считаются закрытыми; без сессий поток завершается
+        with tail['lock']:
+            deadline = time.monotonic() - tail['interval'] * SESSION_TIMEOUT_INTERVALS
+            tail['sessions'] = {
+                session_id: seen for session_id, seen in tail['sessions'].items() if seen >= deadline
+            }
+            if not tail['sessions']:
+                tail['stop'].set()
+                logger.info('Фоновая загрузка остановлена: нет сессий с автообновлением')
+                return
+        try:
+            poll_once(
+                store, tail['s3_client'], bucket_name, prefix,
+                tail['max_workers'], tail['parse_pool'], tail['compacted_prefix']
+            )
+        except Exception as e:
+            logger.error(f"Ошибка фоновой загрузки новых файлов: {str(e)}")
+
+
+# Функция для запуска фоновой загрузки новых файлов в хранилище
+def start_live_tail(store, s3_client, bucket_name, prefix, interval=POLL_INTERVAL_SECONDS,
+                    max_workers=DEFAULT_MAX_WORKERS, parse_pool=None, compacted_prefix=None):
+    """Возвращает словарь настроек потока; s3_client, max_workers, parse_pool и compacted_prefix
+    можно менять на ходу. Поток работает, пока к нему подключена хотя бы одна сессия (join_live_tail),
+    остановка - leave_live_tail последней сессии или tail['stop'].set()"""
+    tail = {
+        's3_client': s3_client,
+        'interval': interval,
+        'max_workers': max_workers,
+        'parse_pool': parse_pool,
+        'compacted_prefix': compacted_prefix,
+        'stop': threading.Event(),
+        # Идентификатор сессии -> время последней отметки (time.monotonic)
+        'sessions': {},
+        'lock': threading.Lock(),
+    }
+    tail['thread'] = threading.Thread(
+        target=run_live_tail,
+        args=(tail, store, bucket_name, prefix),
+        name='live-tail',
+        daemon=True
+    )
+    tail['thread'].start()
+    return tail
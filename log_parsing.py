@@ -0,0 +1,379 @@
+import io
+import json
+import logging
+import re
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
+
+from diagnostics import DIAGNOSTICS, count, timed
+from schema import apply_schema
+
+# orjson заметно быстрее стандартного json; если он не установлен, используем stdlib
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    JSON_DECODE_ERRORS = (orjson.JSONDecodeError, UnicodeDecodeError)
+except ImportError:
+    def json_loads(data):
+        return json.loads(data)
+
+    JSON_DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+logger = logging.getLogger('gift-dashboard')
+
+# Форматы содержимого файла
+FORMAT_EMPTY = 'empty'
+FORMAT_JSON = 'json'
+FORMAT_NDJSON = 'ndjson'
+
+# Сколько байт смотрим для определения формата
+SNIFF_SIZE = 64 * 1024
+
+# Расширения файлов логов: единый JSON-документ или JSON по строкам
+LOG_SUFFIXES = ('.json', '.ndjson', '.jsonl')
+
+# Сжатые файлы логов: расширение ключа -> кодек Arrow
+COMPRESSION_SUFFIXES = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Сигнатуры сжатых данных (для объектов без расширения сжатия)
+COMPRESSION_MAGIC = {b'\x1f\x8b': 'gzip', b'\x28\xb5\x2f\xfd': 'zstd'}
+
+
+# Функция для определения сжатия по ключу объекта (None - без сжатия)
+def compression_for_key(file_key):
+    for suffix, compression in COMPRESSION_SUFFIXES.items():
+        if file_key.endswith(suffix):
+            return compression
+    return None
+
+
+# Функция для получения ключа без расширения сжатия: x.json.gz -> x.json
+def strip_compression_suffix(file_key):
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_key.endswith(suffix):
+            return file_key[:-len(suffix)]
+    return file_key
+
+
+# Функция для проверки, является ли объект файлом лога (в том числе сжатым)
+def is_log_key(file_key):
+    return strip_compression_suffix(file_key).endswith(LOG_SUFFIXES)
+
+
+# Функция для определения сжатия по первым байтам данных
+def sniff_compression(data):
+    for magic, compression in COMPRESSION_MAGIC.items():
+        if data[:len(magic)] == magic:
+            return compression
+    return None
+
+
+# Функция для открытия потока распаковки gzip/zstd над сжатыми байтами
+def open_decompressed(data, compression):
+    """Данные распаковываются блоками по мере чтения из потока"""
+    return pa.CompressedInputStream(pa.BufferReader(data), compression)
+
+
+# Функция для распаковки gzip/zstd целиком (для единого JSON-документа, которому нужен весь текст)
+def read_decompressed(data, compression):
+    with open_decompressed(data, compression) as decompressed:
+        return decompressed.read()
+
+
+# Функция для потокового разбора сжатого NDJSON: распакованные байты целиком в памяти не держатся
+def parse_compressed_ndjson(data, compression):
+    """Возвращает DataFrame или None, если файл - не NDJSON или в нем есть битые строки
+    (тогда файл распаковывается целиком и разбирается обычным путем)"""
+    with open_decompressed(data, compression) as decompressed:
+        head = decompressed.read(SNIFF_SIZE)
+    if sniff_format(head) != FORMAT_NDJSON:
+        return None
+    try:
+        with open_decompressed(data, compression) as decompressed:
+            # C-парсер Arrow читает распаковщик блоками и собирает колонки
+            table = pa_json.read_json(decompressed)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return None
+    return table.to_pandas() if table.num_rows else None
+
+
+# Функция для определения формата файла по первым байтам
+def sniff_format(data):
+    """Возвращает FORMAT_EMPTY, FORMAT_JSON (единый документ) или FORMAT_NDJSON (JSON по строкам)"""
+    head = data[:SNIFF_SIZE].lstrip(b'\xef\xbb\xbf \t\r\n')
+    if not head:
+        return FORMAT_EMPTY
+
+    # Массив (в том числе список списков) - всегда единый документ
+    if not head.startswith(b'{'):
+        return FORMAT_JSON
+
+    # Объект: NDJSON, если первая строка - законченный JSON и за ней есть еще данные
+    first_line, _, rest = head.partition(b'\n')
+    if not rest.strip():
+        return FORMAT_JSON
+    try:
+        json_loads(first_line)
+    except JSON_DECODE_ERRORS:
+        return FORMAT_JSON
+    return FORMAT_NDJSON
+
+
+# Функция для разбора NDJSON из байт сразу в колонки
+def parse_ndjson(data):
+    """Возвращает (DataFrame или None, количество пропущенных строк)"""
+    # Быстрый путь: C-парсер Arrow читает байты сразу в колоночный формат
+    try:
+        table = pa_json.read_json(io.BytesIO(data))
+        if table.num_rows:
+            return table.to_pandas(), 0
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+
+    lines = [line for line in data.splitlines() if line.strip()]
+
+    # Обычно битые строки - обрезанные записи или посторонний текст: отсекаем их по скобкам
+    # и снова читаем оставшееся колоночно
+    object_lines = [line for line in lines if line.lstrip().startswith(b'{') and line.rstrip().endswith(b'}')]
+    if object_lines and len(object_lines) < len(lines):
+        try:
+            table = pa_json.read_json(io.BytesIO(b'\n'.join(object_lines)))
+            return table.to_pandas(), len(lines) - len(object_lines)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            pass
+
+    # Медленный путь: разбираем построчно, считая битые строки
+    good_lines = []
+    records = []
+    bad_lines = 0
+    for line in lines:
+        try:
+            record = json_loads(line)
+        except JSON_DECODE_ERRORS:
+            bad_lines += 1
+            continue
+        if not isinstance(record, dict):
+            bad_lines += 1
+            continue
+        good_lines.append(line)
+        records.append(record)
+
+    if not records:
+        return None, bad_lines
+
+    # Оставшиеся строки снова пробуем разобрать колоночно, иначе - из словарей
+    try:
+        table = pa_json.read_json(io.BytesIO(b'\n'.join(good_lines)))
+        return table.to_pandas(), bad_lines
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return pd.DataFrame(records), bad_lines
+
+
+# Функция для разбора содержимого файла (байты) в данные для process_json_data
+def parse_log_bytes(data):
+    """Возвращает (данные, формат, количество пропущенных строк).
+
+    Данные - результат разбора единого JSON-документа или DataFrame для NDJSON, None если разобрать не удалось.
+    Сжатые данные (gzip, zstd) распознаются по сигнатуре: NDJSON разбирается прямо из потока распаковки,
+    единый документ (и NDJSON с битыми строками) распаковывается целиком.
+    """
+    compression = sniff_compression(data)
+    if compression:
+        try:
+            # Для потокового NDJSON этап decompress включает и разбор
+            with timed('decompress') as info:
+                info['bytes'] = len(data)
+                df = parse_compressed_ndjson(data, compression)
+                info['rows'] = len(df) if df is not None else 0
+            if df is not None:
+                return df, FORMAT_NDJSON, 0
+
+            with timed('decompress') as info:
+                info['bytes'] = len(data)
+                data = read_decompressed(data, compression)
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Не удалось распаковать данные ({compression}): {str(e)}")
+            return None, compression, 0
+
+    with timed('decode') as info:
+        info['bytes'] = len(data)
+        file_format = sniff_format(data)
+        if file_format == FORMAT_EMPTY:
+            # Пустой файл - интервал без транзакций, а не ошибка
+            return [], file_format, 0
+
+        if file_format == FORMAT_JSON:
+            try:
+                json_data = json_loads(data)
+                info['rows'] = len(json_data) if isinstance(json_data, list) else 0
+                return json_data, file_format, 0
+            except JSON_DECODE_ERRORS:
+                # Например, первая строка NDJSON оказалась битой
+                file_format = FORMAT_NDJSON
+
+        df, bad_lines = parse_ndjson(data)
+        info['rows'] = len(df) if df is not None else 0
+        info['error'] = df is None
+        count('bad_lines', bad_lines)
+        return df, file_format, bad_lines
+
+
+# Функция для обработки данных JSON и преобразования в DataFrame
+def process_json_data(json_data, file_name):
+    started = time.perf_counter()
+    try:
+        # Данные NDJSON уже разобраны в DataFrame
+        if isinstance(json_data, pd.DataFrame):
+            # Подробности по каждому файлу - только на уровне DEBUG: при тысячах файлов это заметная работа
+            if logger.isEnabledFor(logging.DEBUG) and not json_data.empty:
+                logger.debug(f"Первый элемент в файле: {json_data.iloc[0].to_dict()}")
+            df = json_data
+        # Пустой список (или пустой файл) - интервал без транзакций: файл загружен, строк в нем нет
+        elif isinstance(json_data, list) and not json_data:
+            df = pd.DataFrame()
+        # Проверяем формат JSON-данных
+        elif isinstance(json_data, list):
+            # Проверяем формат первого элемента
+            first_item = json_data[0]
+            logger.debug("Первый элемент в файле: %s", first_item)
+
+            # Если первый элемент - список, а не словарь
+            if isinstance(first_item, list):
+                logger.debug("Обнаружен список списков, строим DataFrame по строкам")
+
+                # Предполагаем, что в первой строке заголовки столбцов
+                if len(json_data) > 1:
+                    headers = json_data[0]
+                    try:
+                        # Строки передаем как есть, без промежуточных словарей
+                        df = pd.DataFrame(json_data[1:], columns=headers)
+                    except ValueError:
+                        # Строки длиннее заголовков: обрезаем лишние значения, как zip
+                        df = pd.DataFrame([row[:len(headers)] for row in json_data[1:]], columns=headers)
+                else:
+                    # Если только один список (заголовки без строк), создаем пустой DataFrame
+                    df = pd.DataFrame(columns=json_data[0])
+            else:
+                # Стандартный список словарей
+                try:
+                    logger.debug("Ключи в первой записи: %s", list(first_item.keys()))
+                    df = pd.DataFrame(json_data)
+                except (AttributeError, TypeError) as e:
+                    # Если элементы не словари, пробуем преобразовать их
+                    logger.error(f"Ошибка при обработке данных: {e}")
+                    logger.info(f"Пробуем обработать как простые значения")
+
+                    # Пробуем создать DataFrame с одним столбцом
+                    df = pd.DataFrame({
+                        'Value': json_data,
+                        'UserId': range(len(json_data)),  # Создаем уникальные ID
+                        'InvoiceType': 0,  # Заглушка
+                        'Amount': 0  # Заглушка
+                    })
+        else:
+            error_message = f"Неожиданный формат данных в файле {file_name}: Данные не являются списком JSON-объектов"
+            logger.error(error_message)
+            return None, error_message
+
+        # Логируем колонки DataFrame
+        logger.debug("Колонки в DataFrame: %s", df.columns.tolist() if not df.empty else '[пусто]')
+        parsed = time.perf_counter()
+        DIAGNOSTICS.record('parse', parsed - started, rows=len(df))
+
+        # Пропускаем записи с TestMode=true
+        if 'TestMode' in df.columns:
+            rows_before = len(df)
+            df = df[df['TestMode'] != True]
+            count('testmode_dropped', rows_before - len(df))
+
+        # Добавляем имя файла к каждой записи
+        df['file_name'] = file_name
+
+        # Если есть временная метка, преобразуем её в читаемую дату
+        if 'Timestamp' in df.columns:
+            df['Datetime'] = pd.to_datetime(df['Timestamp'], unit='s')
+            # Добавляем колонки с часом и днем для анализа
+            df['Hour'] = df['Datetime'].dt.hour
+            # Дата - datetime64 без времени, а не объекты date Python
+            df['Date'] = df['Datetime'].dt.normalize()
+        else:
+            # Если нет временной метки, используем дату из имени файла
+            date_match = re.search(r'(\d{4}-\d{2}-\d{2})', file_name)
+            if date_match:
+                file_date = date_match.group(1)
+                df['Date'] = pd.to_datetime(file_date)
+
+                # Извлекаем час из имени файла
+                hour_match = re.search(r'\d{4}-\d{2}-\d{2}-(\d{2})-\d{2}', file_name)
+                hour = int(hour_match.group(1)) if hour_match else 0
+                df['Hour'] = hour
+
+        # Добавляем необходимые поля, если их нет
+        if 'UserId' not in df.columns:
+            df['UserId'] = range(len(df))  # Создаем уникальные ID
+
+        if 'InvoiceType' not in df.columns:
+            df['InvoiceType'] = 0  # Заглушка
+
+        if 'Amount' not in df.columns:
+            df['Amount'] = 0  # Заглушка
+
+        # Приводим колонки к компактной схеме
+        df = apply_schema(df)
+        DIAGNOSTICS.record('normalize', time.perf_counter() - parsed, rows=len(df))
+        return df, None
+    except Exception as e:
+        error_message = f"Ошибка при обработке данных из файла {file_name}: {str(e)}"
+        logger.error(error_message)
+        DIAGNOSTICS.record('parse', time.perf_counter() - started, error=True)
+        return None, error_message
+
+
+# Функция для сериализации DataFrame в Arrow IPC для передачи между процессами
+def frame_to_ipc(df):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+# Функция для восстановления DataFrame из Arrow IPC
+def frame_from_ipc(data):
+    return pa.ipc.open_stream(data).read_all().to_pandas()
+
+
+# Функция инициализации процесса-обработчика (initializer пула, выполняется сразу после fork)
+def init_parse_worker():
+    # Блокировки логирования Python пересоздает после fork сам, блокировку сборщика диагностики - мы
+    DIAGNOSTICS.reinit_after_fork()
+
+
+# Функция для разбора и нормализации файла в процессе-обработчике
+def parse_file_to_ipc(data, file_key):
+    """Возвращает (данные, ошибка разбора, ошибка обработки, количество пропущенных строк, диагностика).
+
+    Данные - Arrow IPC (bytes); если колонки не переводятся в Arrow, возвращается сам DataFrame.
+    Диагностика - итоги этапов в процессе-обработчике (DIAGNOSTICS.snapshot) для объединения в основном процессе.
+    """
+    # Процесс-обработчик выполняет одну задачу за раз: собираем итоги только этого файла
+    DIAGNOSTICS.reset()
+    json_data, file_format, bad_lines = parse_log_bytes(data)
+    if json_data is None:
+        return None, f"Не удалось разобрать файл {file_key} как JSON", None, bad_lines, DIAGNOSTICS.snapshot()
+
+    df, process_error = process_json_data(json_data, file_key)
+    if process_error:
+        return None, None, process_error, bad_lines, DIAGNOSTICS.snapshot()
+
+    try:
+        return frame_to_ipc(df), None, None, bad_lines, DIAGNOSTICS.snapshot()
+    except (pa.ArrowException, TypeError, ValueError) as e:
+        logger.warning(f"Файл {file_key} передается без Arrow: {str(e)}")
+        return df, None, None, bad_lines, DIAGNOSTICS.snapshot()
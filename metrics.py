@@ -0,0 +1,200 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from diagnostics import METRIC_STAGE_PREFIX, timed
+from hll import merge_sketches
+
+logger = logging.getLogger('gift-dashboard')
+
+# Глубина таблицы конверсии по номеру спина
+SPIN_DEPTH = 10
+
+# Способы разбивки воронки по спинам
+SEGMENT_COHORT = 'cohort'
+SEGMENT_INVOICE_TYPE = 'invoice_type'
+NO_DATE_COHORT = 'Без даты'
+
+
+# Функция для расчета воронки по спинам сразу для всех порогов и сегментов
+def spin_funnel(payment_counts, segment_codes=None, segment_count=1, depth=SPIN_DEPTH):
+    """Возвращает (матрицу [сегмент, спин - 1] с количеством пользователей, сделавших хотя бы spin оплат,
+    размеры сегментов).
+
+    Одна гистограмма по (сегмент, количество оплат, обрезанное до depth) и обратная накопленная сумма -
+    O(пользователей + сегментов * depth) вместо прохода по пользователям на каждый порог.
+    """
+    counts = np.minimum(np.asarray(payment_counts, dtype=np.int64), depth)
+    if segment_codes is None:
+        segment_codes = np.zeros(counts.size, dtype=np.int64)
+
+    histogram = np.bincount(
+        np.asarray(segment_codes, dtype=np.int64) * (depth + 1) + counts,
+        minlength=segment_count * (depth + 1)
+    ).reshape(segment_count, depth + 1)
+    reached = histogram[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return reached[:, 1:], histogram.sum(axis=1)
+
+
+# Функция для расчета конверсии по номеру спина из количества оплат на пользователя
+def spin_conversion_table(payment_counts, total_users, depth=SPIN_DEPTH):
+    """payment_counts - количество оплат каждого пользователя (включая пользователей без оплат)"""
+    reached, _ = spin_funnel(payment_counts, depth=depth)
+    return spin_table(reached[0], total_users)
+
+
+# Функция для построения таблицы конверсии из количества пользователей, дошедших до каждого спина
+def spin_table(users_with_spins, total_users):
+    users_with_spins = np.asarray(users_with_spins, dtype=np.int64)
+    depth = users_with_spins.size
+    conversion_rate = users_with_spins / total_users * 100 if total_users > 0 else np.zeros(depth)
+
+    return pd.DataFrame({
+        'Номер спина': np.arange(1, depth + 1),
+        'Количество пользователей': users_with_spins,
+        'Процент конверсии': np.round(conversion_rate, 2),
+    })
+
+
+# Функция для расчета воронки по спинам с разбивкой на сегменты (с замером этапа)
+def segmented_spin_conversion(rollup, depth=SPIN_DEPTH, segment_by=SEGMENT_COHORT):
+    with timed(f"{METRIC_STAGE_PREFIX}segmented_funnel", segment_by=segment_by) as info:
+        info['rows'] = len(rollup['user_days'])
+        return build_segmented_spin_conversion(rollup, depth, segment_by)
+
+
+# Функция для построения таблицы воронки по спинам с разбивкой на сегменты
+def build_segmented_spin_conversion(rollup, depth=SPIN_DEPTH, segment_by=SEGMENT_COHORT):
+    """Возвращает таблицу (Сегмент, Размер сегмента, Номер спина, Количество пользователей, Процент конверсии).
+
+    SEGMENT_COHORT - когорты по дню первого появления пользователя в периоде, спины - оплаты;
+    SEGMENT_INVOICE_TYPE - для каждого типа счета спины - транзакции этого типа, база - все пользователи.
+    """
+    user_days = rollup['user_days']
+    user_days = user_days[user_days['UserId'].notna()]
+
+    if segment_by == SEGMENT_INVOICE_TYPE:
+        user_types = rollup.get('user_types')
+        if user_types is None:
+            return None
+        total_users = int(user_days['UserId'].nunique())
+        user_types = user_types[user_types['UserId'].notna() & user_types['InvoiceType'].notna()]
+        segment_codes, segments = pd.factorize(user_types['InvoiceType'], sort=True)
+        reached, _ = spin_funnel(user_types['count'], segment_codes, len(segments), depth)
+        # Пользователи без транзакций типа тоже входят в базу сегмента
+        sizes = np.full(len(segments), total_users)
+        segment_names = [f"Тип {segment}" for segment in segments]
+    else:
+        grouped = user_days.groupby('UserId', observed=True)
+        payment_counts = grouped['paid_count'].sum()
+        first_seen = grouped['Date'].min()
+        cohorts = first_seen.dt.strftime('%Y-%m-%d').fillna(NO_DATE_COHORT)
+        segment_codes, segments = pd.factorize(cohorts, sort=True)
+        reached, sizes = spin_funnel(payment_counts.to_numpy(), segment_codes, len(segments), depth)
+        segment_names = list(segments)
+
+    if not segment_names:
+        return None
+
+    conversion_rate = np.divide(
+        reached * 100, sizes[:, None], out=np.zeros(reached.shape), where=sizes[:, None] > 0
+    )
+    return pd.DataFrame({
+        'Сегмент': np.repeat(segment_names, depth),
+        'Размер сегмента': np.repeat(sizes, depth),
+        'Номер спина': np.tile(np.arange(1, depth + 1), len(segment_names)),
+        'Количество пользователей': reached.ravel(),
+        'Процент конверсии': np.round(conversion_rate.ravel(), 2),
+    })
+
+
+# Функция для приближенного подсчета пользователей по скетчам HyperLogLog агрегата
+def approximate_user_metrics(rollup, precision=None):
+    """Возвращает (всего пользователей, платящих, пользователи по дням, платящие по дням) - оценки HLL.
+    precision - точность, до которой понижаются скетчи (None - точность построения)"""
+    sketches = rollup.get('sketches', {})
+    if precision is not None:
+        sketches = {
+            day: (users.fold(min(precision, users.precision)), paying.fold(min(precision, paying.precision)))
+            for day, (users, paying) in sketches.items()
+        }
+
+    total = merge_sketches([users for users, _ in sketches.values()])
+    paying_total = merge_sketches([paying for _, paying in sketches.values()])
+
+    days = sorted(day for day in sketches if day is not None)
+    users_daily = pd.DataFrame({
+        'Date': pd.to_datetime(days),
+        'Уникальные пользователи': [sketches[day][0].count() for day in days],
+    })
+    paying_users_daily = pd.DataFrame({
+        'Date': pd.to_datetime(days),
+        'Платящие пользователи': [sketches[day][1].count() for day in days],
+    })
+    # Как и в точном режиме, дни без платящих пользователей в график не попадают
+    paying_users_daily = paying_users_daily[paying_users_daily['Платящие пользователи'] > 0].reset_index(drop=True)
+
+    return (
+        total.count() if total is not None else 0,
+        paying_total.count() if paying_total is not None else 0,
+        users_daily,
+        paying_users_daily,
+        total.relative_error() if total is not None else None,
+    )
+
+
+# Функция для расчета всех метрик дашборда из объединенного агрегата (см. rollups.py)
+def compute_rollup_metrics(rollup, approximate=False, precision=None, spin_depth=SPIN_DEPTH):
+    """Рассчитывает основные метрики, данные для графиков по дням и конверсию по спинам.
+
+    При approximate=True количество пользователей (всего, платящих, по дням) оценивается только по скетчам
+    HyperLogLog, пары (Date, UserId) не просматриваются; конверсия по спинам требует количества оплат
+    каждого пользователя и в этом режиме не рассчитывается (None).
+    """
+    relative_error = None
+    spin_conversion = None
+    if approximate:
+        with timed(f"{METRIC_STAGE_PREFIX}users_hll"):
+            total_users, paying_users, users_daily, paying_users_daily, relative_error = approximate_user_metrics(
+                rollup, precision
+            )
+    else:
+        user_days = rollup['user_days']
+        known_user = user_days['UserId'].notna()
+
+        # Количество оплат на пользователя за весь период
+        with timed(f"{METRIC_STAGE_PREFIX}payment_counts") as info:
+            info['rows'] = len(user_days)
+            payment_counts = user_days[known_user].groupby('UserId', observed=True)['paid_count'].sum()
+        total_users = int(payment_counts.size)
+        paying_users = int((payment_counts > 0).sum())
+
+        with timed(f"{METRIC_STAGE_PREFIX}spin_conversion") as info:
+            info['rows'] = total_users
+            spin_conversion = spin_conversion_table(payment_counts, total_users, spin_depth)
+
+        # Графики по дням
+        with timed(f"{METRIC_STAGE_PREFIX}users_daily") as info:
+            info['rows'] = len(user_days)
+            day_values = user_days[known_user & user_days['Date'].notna()]
+            users_daily = day_values.groupby('Date').size().rename('Уникальные пользователи').reset_index()
+            paying_users_daily = (
+                day_values[day_values['paid_count'] > 0]
+                .groupby('Date').size()
+                .rename('Платящие пользователи').reset_index()
+            )
+
+    with timed(f"{METRIC_STAGE_PREFIX}total_deposits"):
+        total_deposits = float(rollup['daily_amount']['Amount'].sum())
+
+    return {
+        'total_users': total_users,
+        'paying_users': paying_users,
+        'total_deposits': total_deposits,
+        'users_daily': users_daily,
+        'paying_users_daily': paying_users_daily,
+        'spin_conversion': spin_conversion,
+        'approximate': approximate,
+        'relative_error': relative_error,
+    }
@@ -0,0 +1,216 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+from hll import hash_user_ids
+
+# pyroaring - необязательная зависимость: без нее битовые карты хранятся упакованными массивами numpy
+try:
+    from pyroaring import BitMap
+except ImportError:
+    BitMap = None
+
+# Дни удержания для сводки (D1, D7, D30)
+RETENTION_DAYS = (1, 7, 30)
+
+# Сколько дней после дня когорты показывать в матрице
+MAX_COHORT_OFFSET = 30
+
+# Виды удержания: когорта по первой активности и активность, или по первой оплате и оплата
+RETENTION_ACTIVE = 'active'
+RETENTION_PAYING = 'paying'
+
+
+# Функция для получения названия реализации битовых карт
+def bitmap_backend():
+    return 'pyroaring' if BitMap is not None else 'numpy'
+
+
+# Функция для подсчета единичных битов в массиве байт
+def popcount(bits):
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(np.unpackbits(bits).sum(dtype=np.int64))
+
+
+class PackedBitmap:
+    """Битовая карта на упакованном массиве numpy (если pyroaring не установлен).
+
+    Поддерживает те же операции, что и pyroaring.BitMap: &, |, - (разность) и len (количество элементов);
+    массивы разной длины (словарь пользователей растет) выравниваются нулями.
+    """
+
+    def __init__(self, bits=None):
+        self.bits = bits if bits is not None else np.zeros(0, dtype=np.uint8)
+
+    # Метод для выравнивания длины с другой картой
+    def _aligned(self, other):
+        size = max(self.bits.size, other.bits.size)
+        left = np.zeros(size, dtype=np.uint8)
+        right = np.zeros(size, dtype=np.uint8)
+        left[:self.bits.size] = self.bits
+        right[:other.bits.size] = other.bits
+        return left, right
+
+    def __and__(self, other):
+        size = min(self.bits.size, other.bits.size)
+        return PackedBitmap(self.bits[:size] & other.bits[:size])
+
+    def __or__(self, other):
+        left, right = self._aligned(other)
+        return PackedBitmap(left | right)
+
+    def __sub__(self, other):
+        left, right = self._aligned(other)
+        return PackedBitmap(left & ~right)
+
+    def __len__(self):
+        return popcount(self.bits)
+
+
+# Функция для построения битовой карты по кодам пользователей
+def make_bitmap(codes):
+    codes = np.unique(np.asarray(codes, dtype=np.uint32))
+    if BitMap is not None:
+        return BitMap(codes)
+    if codes.size == 0:
+        return PackedBitmap()
+    bits = np.zeros(int(codes[-1]) // 8 + 1, dtype=np.uint8)
+    np.bitwise_or.at(bits, codes >> 3, (1 << (codes & 7)).astype(np.uint8))
+    return PackedBitmap(bits)
+
+
+# Функция для получения пустой битовой карты
+def empty_bitmap():
+    return BitMap() if BitMap is not None else PackedBitmap()
+
+
+# Функция для подсчета памяти битовой карты (в байтах)
+def bitmap_nbytes(bitmap):
+    if isinstance(bitmap, PackedBitmap):
+        return int(bitmap.bits.nbytes)
+    return len(bitmap.serialize())
+
+
+class UserDictionary:
+    """Плотный словарь пользователей: 64-битный хеш UserId -> код 0..n-1.
+
+    Коды только добавляются, поэтому битовые карты разных дней, построенные в разное время, сопоставимы.
+    Хеш (см. hll.hash_user_ids) одинаков для одного пользователя во всех файлах, если UserId приходит одного типа;
+    целые значения, пришедшие как float, хешируются как int, но строка '5' и число 5 - разные пользователи.
+    Словарь только растет, его память учитывается в лимите хранилища (см. DatasetStore.memory_usage).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.index = pd.Index(np.empty(0, dtype=np.uint64))
+
+    # Метод для получения кодов пользователей (новые пользователи добавляются в словарь)
+    def encode(self, user_ids):
+        hashes = hash_user_ids(user_ids)
+        with self.lock:
+            codes = self.index.get_indexer(hashes)
+            missing = codes < 0
+            if missing.any():
+                self.index = self.index.append(pd.Index(pd.unique(hashes[missing])))
+                codes[missing] = self.index.get_indexer(hashes[missing])
+        return codes.astype(np.uint32)
+
+    # Метод для подсчета памяти словаря (в байтах, вместе с хеш-таблицей поиска)
+    def nbytes(self):
+        with self.lock:
+            return int(self.index.memory_usage())
+
+    def __len__(self):
+        return len(self.index)
+
+
+# Функция для построения битовых карт активных и платящих пользователей по дням агрегата
+def build_day_bitmaps(rollup, dictionary):
+    """Возвращает {день (Timestamp): (активные, платящие)}; строки без даты или пользователя пропускаются"""
+    if rollup is None:
+        return {}
+    user_days = rollup['user_days']
+    user_days = user_days[user_days['UserId'].notna() & user_days['Date'].notna()]
+    if user_days.empty:
+        return {}
+
+    codes = dictionary.encode(user_days['UserId'])
+    paid = (user_days['paid_count'] > 0).to_numpy()
+    dates = user_days['Date'].to_numpy()
+
+    bitmaps = {}
+    for day in pd.unique(dates):
+        in_day = dates == day
+        bitmaps[pd.Timestamp(day)] = (make_bitmap(codes[in_day]), make_bitmap(codes[in_day & paid]))
+    return bitmaps
+
+
+# Функция для объединения битовых карт по дням из нескольких разделов
+def merge_day_bitmaps(bitmap_maps):
+    merged = {}
+    for bitmap_map in bitmap_maps:
+        for day, (active, paying) in bitmap_map.items():
+            if day in merged:
+                active, paying = merged[day][0] | active, merged[day][1] | paying
+            merged[day] = (active, paying)
+    return dict(sorted(merged.items()))
+
+
+# Функция для подсчета памяти битовых карт раздела (в байтах)
+def day_bitmaps_nbytes(bitmaps):
+    return sum(bitmap_nbytes(active) + bitmap_nbytes(paying) for active, paying in bitmaps.values())
+
+
+# Функция для расчета когорт: новые пользователи каждого дня и битовые карты дней
+def cohort_bitmaps(day_bitmaps, kind=RETENTION_ACTIVE):
+    """Возвращает (дни подряд от первого до последнего, когорты, карты дней). Когорта дня - пользователи,
+    впервые активные (kind=RETENTION_PAYING - впервые оплатившие) в этот день выбранного периода"""
+    if not day_bitmaps:
+        return [], [], []
+    position = 0 if kind == RETENTION_ACTIVE else 1
+    days = list(pd.date_range(min(day_bitmaps), max(day_bitmaps), freq='D'))
+    bitmaps = [day_bitmaps[day][position] if day in day_bitmaps else empty_bitmap() for day in days]
+
+    seen = empty_bitmap()
+    cohorts = []
+    for bitmap in bitmaps:
+        cohorts.append(bitmap - seen)
+        seen = seen | bitmap
+    return days, cohorts, bitmaps
+
+
+# Функция для построения матрицы удержания по когортам
+def cohort_matrix(day_bitmaps, kind=RETENTION_ACTIVE, max_offset=MAX_COHORT_OFFSET):
+    """Возвращает DataFrame: строки - когорты (Когорта, Размер когорты), колонки 'День N' - доля когорты (%),
+    активной (оплатившей) через N дней. Одно пересечение карт на ячейку, без объединений DataFrame"""
+    days, cohorts, bitmaps = cohort_bitmaps(day_bitmaps, kind)
+    rows = []
+    for i, (day, cohort) in enumerate(zip(days, cohorts)):
+        size = len(cohort)
+        if not size:
+            continue
+        row = {'Когорта': day.strftime('%Y-%m-%d'), 'Размер когорты': size}
+        for offset in range(1, min(max_offset, len(days) - 1 - i) + 1):
+            row[f"День {offset}"] = round(len(cohort & bitmaps[i + offset]) * 100 / size, 2)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+# Функция для расчета сводного удержания D1/D7/D30
+def retention_summary(day_bitmaps, kind=RETENTION_ACTIVE, offsets=RETENTION_DAYS):
+    """Для каждого N - доля пользователей когорт, у которых день когорты + N входит в период,
+    вернувшихся в этот день. Возвращает DataFrame (День, Пользователей в когортах, Вернулись, Удержание, %)"""
+    days, cohorts, bitmaps = cohort_bitmaps(day_bitmaps, kind)
+    rows = []
+    for offset in offsets:
+        eligible = sum(len(cohorts[i]) for i in range(len(days) - offset))
+        retained = sum(len(cohorts[i] & bitmaps[i + offset]) for i in range(len(days) - offset))
+        rows.append({
+            'День': f"D{offset}",
+            'Пользователей в когортах': eligible,
+            'Вернулись': retained,
+            'Удержание, %': round(retained * 100 / eligible, 2) if eligible else None,
+        })
+    return pd.DataFrame(rows)
@@ -0,0 +1,148 @@
+import logging
+
+import pandas as pd
+
+from activity_cube import build_cube, cube_memory_usage, merge_cubes
+from diagnostics import timed
+from hll import DEFAULT_PRECISION, HyperLogLog, hash_user_ids, merge_sketches
+from schema import concat_frames, frame_memory_usage
+
+logger = logging.getLogger('gift-dashboard')
+
+# Тип счета, означающий оплаченную транзакцию
+PAID_INVOICE_TYPE = 1
+
+
+# Функция для построения скетчей HyperLogLog пользователей по дням
+def build_day_sketches(df, paid, precision=DEFAULT_PRECISION):
+    """Возвращает {день: (скетч всех пользователей, скетч платящих)}, строки без даты - под ключом None"""
+    known_user = df['UserId'].notna().to_numpy()
+    hashes = hash_user_ids(df['UserId'])
+    dates = df['Date'].to_numpy()[known_user]
+    paid = paid.to_numpy()[known_user]
+
+    sketches = {}
+    for day in pd.unique(dates):
+        in_day = pd.isna(dates) if pd.isna(day) else dates == day
+        key = None if pd.isna(day) else pd.Timestamp(day)
+        users = HyperLogLog(precision).add_hashes(hashes[in_day])
+        paying = HyperLogLog(precision).add_hashes(hashes[in_day & paid])
+        sketches[key] = (users, paying)
+    return sketches
+
+
+# Функция для объединения скетчей пользователей по дням из нескольких агрегатов
+def merge_day_sketches(sketch_maps):
+    days = list(dict.fromkeys(day for sketch_map in sketch_maps for day in sketch_map))
+    return {
+        day: (
+            merge_sketches([sketch_map[day][0] for sketch_map in sketch_maps if day in sketch_map]),
+            merge_sketches([sketch_map[day][1] for sketch_map in sketch_maps if day in sketch_map]),
+        )
+        for day in days
+    }
+
+
+# Функция для построения частичного агрегата (rollup) по обработанному файлу
+def build_rollup(df, precision=DEFAULT_PRECISION):
+    """Возвращает словарь агрегатов файла, из которых выводятся все метрики дашборда:
+
+    user_days - уникальные пары (Date, UserId) с количеством оплат пользователя за день,
+    daily_amount - сумма оплаченных транзакций по дням,
+    user_types - количество транзакций пользователя каждого типа (InvoiceType) за файл,
+    sketches - скетчи HyperLogLog всех и платящих пользователей по дням (для приближенного режима),
+    cube - куб активности час × день (см. activity_cube.py),
+    rows - количество исходных строк.
+    """
+    if df is None or df.empty:
+        return None
+
+    # InvoiceType - nullable Int8: строки без типа не считаются оплаченными (маска без NA для всех агрегатов)
+    paid = df['InvoiceType'].eq(PAID_INVOICE_TYPE).fillna(False).astype(bool)
+
+    user_days = (
+        paid.astype('int32')
+        .groupby([df['Date'], df['UserId']], observed=True, sort=True, dropna=False)
+        .sum()
+        .rename('paid_count')
+        .reset_index()
+    )
+
+    user_types = (
+        df.groupby(['UserId', 'InvoiceType'], observed=True, sort=True)
+        .size()
+        .astype('int32')
+        .rename('count')
+        .reset_index()
+    )
+
+    amount = pd.to_numeric(df['Amount'], errors='coerce').where(paid, 0.0)
+    daily_amount = (
+        amount.groupby(df['Date'], sort=True, dropna=False)
+        .sum()
+        .rename('Amount')
+        .reset_index()
+    )
+
+    return {
+        'user_days': user_days,
+        'daily_amount': daily_amount,
+        'user_types': user_types,
+        'sketches': build_day_sketches(df, paid, precision),
+        'cube': build_cube(df, paid),
+        'rows': int(len(df)),
+    }
+
+
+# Функция для объединения частичных агрегатов (файлов, дней, периода)
+def merge_rollups(rollups):
+    rollups = [rollup for rollup in rollups if rollup is not None]
+    if not rollups:
+        return None
+    if len(rollups) == 1:
+        return rollups[0]
+
+    with timed('merge', rollups=len(rollups)) as info:
+        info['rows'] = sum(rollup['rows'] for rollup in rollups)
+        user_days = concat_frames([rollup['user_days'] for rollup in rollups])
+        user_days = (
+            user_days.groupby(['Date', 'UserId'], observed=True, sort=True, dropna=False)['paid_count']
+            .sum()
+            .reset_index()
+        )
+
+        daily_amount = pd.concat([rollup['daily_amount'] for rollup in rollups], ignore_index=True)
+        daily_amount = daily_amount.groupby('Date', sort=True, dropna=False)['Amount'].sum().reset_index()
+
+        user_types = concat_frames([rollup.get('user_types') for rollup in rollups])
+        if user_types is not None:
+            user_types = (
+                user_types.groupby(['UserId', 'InvoiceType'], observed=True, sort=True)['count']
+                .sum()
+                .reset_index()
+            )
+
+        return {
+            'user_days': user_days,
+            'daily_amount': daily_amount,
+            'user_types': user_types,
+            'sketches': merge_day_sketches([rollup.get('sketches', {}) for rollup in rollups]),
+            'cube': merge_cubes([rollup.get('cube') for rollup in rollups]),
+            'rows': sum(rollup['rows'] for rollup in rollups),
+        }
+
+
+# Функция для подсчета памяти, занимаемой агрегатом (в байтах)
+def rollup_memory_usage(rollup):
+    if rollup is None:
+        return 0
+    sketch_bytes = sum(
+        users.nbytes() + paying.nbytes() for users, paying in rollup.get('sketches', {}).values()
+    )
+    return (
+        frame_memory_usage(rollup['user_days'])
+        + frame_memory_usage(rollup['daily_amount'])
+        + frame_memory_usage(rollup.get('user_types'))
+        + sketch_bytes
+        + cube_memory_usage(rollup.get('cube'))
+    )
@@ -0,0 +1,96 @@
+import os
+import logging
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger('gift-dashboard')
+
+# Каталог локального кэша обработанных файлов (можно переопределить переменной окружения)
+CACHE_DIR = Path(os.environ.get('GIFT_DASHBOARD_CACHE_DIR', '.cache/s3'))
+
+# Ключи метаданных Parquet, по которым проверяется актуальность записи кэша
+ETAG_METADATA_KEY = b'gift_dashboard.etag'
+SOURCE_KEY_METADATA_KEY = b'gift_dashboard.source_key'
+CACHE_VERSION_METADATA_KEY = b'gift_dashboard.cache_version'
+
+# Версия формата записей кэша: увеличивается при изменении схемы обработанных данных,
+# чтобы записи старого формата перечитывались из S3
+CACHE_VERSION = b'2'
+
+
+# Функция для нормализации ETag (S3 возвращает его в кавычках)
+def normalize_etag(etag):
+    if not etag:
+        return None
+    return str(etag).strip('"')
+
+
+# Функция для получения пути к файлу кэша по ключу S3
+def cache_path_for_key(file_key, cache_dir=CACHE_DIR):
+    # Повторяем структуру ключа, отбрасывая пустые и небезопасные части пути
+    parts = [part for part in file_key.split('/') if part not in ('', '.', '..')]
+    if not parts:
+        raise ValueError(f"Некорректный ключ S3: {file_key!r}")
+    parts[-1] = parts[-1] + '.parquet'
+    return Path(cache_dir).joinpath(*parts)
+
+
+# Функция для чтения обработанного файла из кэша
+def load_cached_frame(file_key, etag, cache_dir=CACHE_DIR):
+    """Возвращает DataFrame из кэша, если запись есть и ETag совпадает, иначе None"""
+    etag = normalize_etag(etag)
+    if etag is None:
+        return None
+
+    path = cache_path_for_key(file_key, cache_dir)
+    if not path.exists():
+        return None
+
+    try:
+        # Сначала читаем только схему (футер файла), чтобы сверить ETag
+        metadata = pq.read_schema(path).metadata or {}
+        if metadata.get(ETAG_METADATA_KEY, b'').decode('utf-8') != etag:
+            return None
+        if metadata.get(CACHE_VERSION_METADATA_KEY) != CACHE_VERSION:
+            return None
+
+        table = pq.read_table(path, memory_map=True)
+        return table.to_pandas()
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать кэш для {file_key}: {str(e)}")
+        return None
+
+
+# Функция для сохранения обработанного файла в кэш
+def save_frame_to_cache(file_key, etag, df, cache_dir=CACHE_DIR):
+    """Сохраняет DataFrame в кэш вместе с ETag исходного объекта. Возвращает True при успехе"""
+    etag = normalize_etag(etag)
+    if etag is None or df is None:
+        return False
+
+    path = cache_path_for_key(file_key, cache_dir)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[ETAG_METADATA_KEY] = etag.encode('utf-8')
+        metadata[SOURCE_KEY_METADATA_KEY] = file_key.encode('utf-8')
+        metadata[CACHE_VERSION_METADATA_KEY] = CACHE_VERSION
+        table = table.replace_schema_metadata(metadata)
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Пишем во временный файл и атомарно переименовываем, чтобы не оставлять битых записей
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить {file_key} в кэш: {str(e)}")
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        return False
@@ -0,0 +1,384 @@
+import logging
+import re
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta, timezone
+
+import boto3
+import pyarrow as pa
+import pyarrow.parquet as pq
+from botocore.config import Config
+
+from diagnostics import DIAGNOSTICS, count, timed
+from log_parsing import (
+    compression_for_key,
+    frame_from_ipc,
+    is_log_key,
+    parse_file_to_ipc,
+    parse_log_bytes,
+    process_json_data,
+    strip_compression_suffix,
+)
+from rollups import build_rollup
+from s3_cache import load_cached_frame, save_frame_to_cache
+from schema import apply_schema
+
+logger = logging.getLogger('gift-dashboard')
+
+# Количество параллельных загрузок из S3 по умолчанию
+DEFAULT_MAX_WORKERS = 16
+
+# Минимальная дата, с которой анализируются данные
+MIN_DATE = date(2025, 4, 9)
+
+# Через сколько после окончания дня (UTC) новые файлы за него больше не ожидаются
+CLOSED_DAY_LAG = timedelta(hours=1)
+
+# Дата в ключе файла S3
+DATE_PATTERN = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+# Суффикс дневных Parquet-разделов, которые пишет compact.py
+COMPACTED_SUFFIX = '.parquet'
+
+# Сколько ждать разбора файла в пуле процессов (секунды): зависший обработчик не должен держать
+# захват дня (и все ожидающие его сессии) бесконечно
+PARSE_TIMEOUT_SECONDS = 300
+
+
+# Функция для подключения к S3
+def connect_to_s3(aws_access_key, aws_secret_key, max_workers=DEFAULT_MAX_WORKERS):
+    try:
+        # Один клиент на все потоки: пул соединений по числу параллельных загрузок
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=aws_access_key,
+            aws_secret_access_key=aws_secret_key,
+            config=Config(
+                max_pool_connections=max_workers,
+                retries={'max_attempts': 5, 'mode': 'adaptive'}
+            )
+        )
+        # Проверка подключения путем запроса списка бакетов
+        s3_client.list_buckets()
+        return s3_client, None
+    except Exception as e:
+        error_message = f"Ошибка подключения к AWS S3: {str(e)}"
+        logger.error(error_message)
+        return None, error_message
+
+
+# Функция для получения префикса дневного раздела (ключи вида <prefix>YYYY-MM-DD...)
+def day_prefix(prefix, day):
+    return f"{prefix}{day}"
+
+
+# Функция для получения списка дней периода в формате YYYY-MM-DD
+def days_in_range(start_date, end_date):
+    return [(start_date + timedelta(days=i)).isoformat() for i in range((end_date - start_date).days + 1)]
+
+
+# Функция для проверки, закрыт ли день (новые файлы за него уже не появятся)
+def is_day_closed(day):
+    day_end = datetime.fromisoformat(day).replace(tzinfo=timezone.utc) + timedelta(days=1)
+    return datetime.now(timezone.utc) >= day_end + CLOSED_DAY_LAG
+
+
+# Функция для постраничного получения объектов по одному префиксу
+def list_objects(s3_client, bucket_name, list_prefix, start_after=None):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    paginate_params = {'Bucket': bucket_name, 'Prefix': list_prefix}
+    if start_after:
+        paginate_params['StartAfter'] = start_after
+
+    objects = []
+    with timed('list', prefix=list_prefix) as info:
+        for page in paginator.paginate(**paginate_params):
+            objects.extend(page.get('Contents', []))
+        info['rows'] = len(objects)
+    return objects
+
+
+# Функция для получения списка файлов в бакете (с поддержкой пагинации)
+# start_after - ключ-watermark: S3 вернет только ключи, которые лексикографически больше него
+# days - список дней: листятся только их подпрефиксы, а не вся история бакета
+def list_files_in_bucket(s3_client, bucket_name, prefix='', start_after=None, days=None):
+    try:
+        if days is None:
+            objects = list_objects(s3_client, bucket_name, prefix, start_after)
+        elif not days:
+            objects = []
+        else:
+            # Дневные подпрефиксы листим параллельно
+            with ThreadPoolExecutor(max_workers=min(len(days), DEFAULT_MAX_WORKERS)) as executor:
+                day_objects = executor.map(
+                    lambda day: list_objects(s3_client, bucket_name, day_prefix(prefix, day), start_after),
+                    days
+                )
+                objects = [obj for objs in day_objects for obj in objs]
+
+        file_list = []
+        wanted_days = set(days) if days is not None else None
+
+        for obj in objects:
+            key = obj['Key']
+            if is_log_key(key):  # .json, .ndjson, .jsonl, в том числе сжатые .gz и .zst
+                match = DATE_PATTERN.search(key)
+                if match:
+                    file_date = match.group(1)
+                    if file_date >= MIN_DATE.isoformat() and (wanted_days is None or file_date in wanted_days):
+                        # Сохраняем весь объект: ETag нужен для проверки локального кэша
+                        file_list.append(obj)
+
+        # На время перехода на сжатие файл может лежать в двух вариантах - берем сжатый, чтобы не считать дважды
+        unique_files = {}
+        for obj in file_list:
+            base_key = strip_compression_suffix(obj['Key'])
+            if base_key not in unique_files or compression_for_key(obj['Key']):
+                unique_files[base_key] = obj
+
+        return list(unique_files.values()), None
+    except Exception as e:
+        error_message = f"Ошибка при получении списка файлов: {str(e)}"
+        logger.error(error_message)
+        return [], error_message
+
+
+# Функция для чтения содержимого объекта S3 (с замером этапа fetch)
+# Сжатые .gz/.zst читаются как есть: распаковка - потоковая, при разборе (см. parse_log_bytes)
+def fetch_object_bytes(s3_client, bucket_name, file_key):
+    with timed('fetch', key=file_key) as info:
+        data = s3_client.get_object(Bucket=bucket_name, Key=file_key)['Body'].read()
+        info['bytes'] = len(data)
+    return data
+
+
+# Функция для разбора содержимого файла в текущем потоке
+def parse_file_bytes(data, file_key):
+    """Возвращает (данные для process_json_data, ошибка)"""
+    # Разбираем байты без декодирования всего файла в строку
+    json_data, file_format, bad_lines = parse_log_bytes(data)
+    
+    if bad_lines:
+        logger.warning(f"В файле {file_key} пропущено строк, не являющихся JSON: {bad_lines}")
+    
+    if json_data is None:
+        return None, f"Не удалось разобрать файл {file_key} как JSON"
+    
+    logger.debug(f"Файл {file_key} загружен (формат: {file_format})")
+    return json_data, None
+
+
+# Функция для загрузки файла из S3
+# (результат обработки кэшируется на диске, см. fetch_and_process_file)
+def load_file_from_s3(s3_client, bucket_name, file_key):
+    try:
+        return parse_file_bytes(fetch_object_bytes(s3_client, bucket_name, file_key), file_key)
+    except Exception as e:
+        error_message = f"Ошибка при загрузке файла {file_key}: {str(e)}"
+        logger.error(error_message)
+        return None, error_message
+
+
+# Функция для проверки, что пул процессов больше не принимает задачи (процесс-обработчик завершился аварийно)
+def is_pool_broken(parse_pool):
+    try:
+        parse_pool.submit(int)
+    except BrokenProcessPool:
+        return True
+    return False
+
+
+# Функция для загрузки файла из S3 и его разбора в пуле процессов
+def load_file_via_process_pool(s3_client, bucket_name, file_key, parse_pool):
+    """Возвращает (DataFrame, ошибка загрузки, ошибка обработки)"""
+    try:
+        # Сжатые данные передаются в процесс как есть (меньше копирования) и распаковываются там
+        data = fetch_object_bytes(s3_client, bucket_name, file_key)
+    except Exception as e:
+        error_message = f"Ошибка при загрузке файла {file_key}: {str(e)}"
+        logger.error(error_message)
+        return None, error_message, None
+    
+    try:
+        # Процесс возвращает колоночный буфер Arrow IPC, а не pickle DataFrame
+        future = parse_pool.submit(parse_file_to_ipc, data, file_key)
+    except RuntimeError as e:
+        # Пул не принимает задачи: процесс-обработчик завершился аварийно (BrokenProcessPool)
+        # или пул уже заменен новым. Файл разбираем в потоке загрузки, пул пересоздается при следующей загрузке
+        logger.warning(f"Пул процессов недоступен ({str(e) or type(e).__name__}), файл {file_key} разбирается в потоке")
+        json_data, load_error = parse_file_bytes(data, file_key)
+        if load_error:
+            return None, load_error, None
+        df, process_error = process_json_data(json_data, file_key)
+        return df, None, process_error
+    
+    try:
+        payload, load_error, process_error, bad_lines, stage_stats = future.result(timeout=PARSE_TIMEOUT_SECONDS)
+    except (TimeoutError, CancelledError, BrokenProcessPool) as e:
+        future.cancel()
+        error_message = f"Ошибка при разборе файла {file_key} в пуле процессов: {str(e) or type(e).__name__}"
+        logger.error(error_message)
+        return None, None, error_message
+    # Этапы разбора выполнялись в другом процессе - переносим их итоги в общий сборщик
+    DIAGNOSTICS.merge(stage_stats)
+    
+    if bad_lines:
+        logger.warning(f"В файле {file_key} пропущено строк, не являющихся JSON: {bad_lines}")
+    
+    if load_error or process_error:
+        return None, load_error, process_error
+    
+    return frame_from_ipc(payload) if isinstance(payload, bytes) else payload, None, None
+
+
+# Функция для получения соседнего префикса дневных разделов: .../5min/ -> .../daily/
+def default_compacted_prefix(prefix):
+    parent = prefix.rstrip('/').rpartition('/')[0]
+    return f"{parent}/daily/" if parent else 'daily/'
+
+
+# Функция для получения ключа дневного раздела
+def compacted_key(compacted_prefix, day):
+    return f"{compacted_prefix}{day}{COMPACTED_SUFFIX}"
+
+
+# Функция для получения дневных разделов, уже подготовленных compact.py
+def list_compacted_days(s3_client, bucket_name, compacted_prefix, days):
+    """Возвращает {день: объект S3 раздела}; при ошибке - пустой словарь (дни читаются из 5-минутных файлов)"""
+    if not days:
+        return {}
+    try:
+        wanted = {compacted_key(compacted_prefix, day): day for day in days}
+        return {
+            wanted[obj['Key']]: obj
+            for obj in list_objects(s3_client, bucket_name, compacted_prefix)
+            if obj['Key'] in wanted
+        }
+    except Exception as e:
+        logger.warning(f"Не удалось получить список дневных разделов {compacted_prefix}: {str(e)}")
+        return {}
+
+
+# Функция для загрузки дневного раздела (Parquet) из S3
+def load_compacted_from_s3(s3_client, bucket_name, file_key):
+    try:
+        data = fetch_object_bytes(s3_client, bucket_name, file_key)
+        with timed('decode', key=file_key) as info:
+            info['bytes'] = len(data)
+            df = apply_schema(pq.read_table(pa.BufferReader(data)).to_pandas())
+            info['rows'] = len(df)
+        return df, None
+    except Exception as e:
+        error_message = f"Ошибка при загрузке раздела {file_key}: {str(e)}"
+        logger.error(error_message)
+        return None, error_message
+
+
+# Функция для загрузки и обработки одного файла (выполняется в потоке пула)
+def fetch_and_process_file(s3_client, bucket_name, file_obj, parse_pool=None):
+    """Возвращает (DataFrame, ошибка, признак попадания в кэш)"""
+    file_key = file_obj['Key']
+    etag = file_obj.get('ETag')
+
+    # Неизменившийся файл читаем из локального кэша без обращения к S3
+    with timed('cache_read', key=file_key) as info:
+        cached_df = load_cached_frame(file_key, etag)
+        info['rows'] = len(cached_df) if cached_df is not None else 0
+    if cached_df is not None:
+        count('cache_hits')
+        return cached_df, None, True
+    count('cache_misses')
+
+    if file_key.endswith(COMPACTED_SUFFIX):
+        # Дневной раздел уже нормализован при сжатии
+        df, load_error = load_compacted_from_s3(s3_client, bucket_name, file_key)
+        process_error = None
+    elif parse_pool is not None:
+        df, load_error, process_error = load_file_via_process_pool(s3_client, bucket_name, file_key, parse_pool)
+    else:
+        json_data, load_error = load_file_from_s3(s3_client, bucket_name, file_key)
+        if not load_error:
+            df, process_error = process_json_data(json_data, file_key)
+
+    if load_error:
+        return None, f"Ошибка при загрузке {file_key}: {load_error}", False
+
+    if process_error:
+        return None, f"Ошибка при обработке {file_key}: {process_error}", False
+
+    with timed('cache_write', key=file_key) as info:
+        save_frame_to_cache(file_key, etag, df)
+        info['rows'] = len(df)
+    return df, None, False
+
+
+# Функция для загрузки файла и построения его агрегата (выполняется в потоке пула)
+def ingest_file(s3_client, bucket_name, file_obj, parse_pool=None):
+    """Возвращает (агрегат файла, ошибка, признак попадания в кэш); сырые строки остаются в кэше на диске"""
+    df, error, cache_hit = fetch_and_process_file(s3_client, bucket_name, file_obj, parse_pool)
+    if error:
+        count('files_failed')
+        return None, error, cache_hit
+    with timed('rollup', key=file_obj['Key']) as info:
+        info['rows'] = len(df)
+        return build_rollup(df), None, cache_hit
+
+
+# Функция для параллельной загрузки файлов: отдает результаты по мере готовности
+def load_files_concurrently(s3_client, bucket_name, file_list, max_workers=DEFAULT_MAX_WORKERS, parse_pool=None):
+    """Загружает файлы пулом потоков и возвращает (индекс, ключ, агрегат, ошибка, из кэша) в порядке завершения"""
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-fetch') as executor:
+        futures = {
+            executor.submit(ingest_file, s3_client, bucket_name, file_obj, parse_pool): (i, file_obj['Key'])
+            for i, file_obj in enumerate(file_list)
+        }
+        for future in as_completed(futures):
+            i, file_key = futures[future]
+            try:
+                rollup, error, cache_hit = future.result()
+            except Exception as e:
+                rollup, error, cache_hit = None, f"Ошибка при загрузке {file_key}: {str(e)}", False
+                logger.error(error)
+            yield i, file_key, rollup, error, cache_hit
+
+
+# Функция для сдвига watermark: до последнего успешно загруженного файла
+def advance_watermark(file_list, ok_keys, watermark=None):
+    """Возвращает (наибольший успешно обработанный ключ, ключи файлов списка с ошибками).
+    Файл с ошибкой не задерживает watermark - его ключ повторяется при следующем обновлении"""
+    failed_keys = set()
+    for file_obj in file_list:
+        if file_obj['Key'] not in ok_keys:
+            failed_keys.add(file_obj['Key'])
+        elif watermark is None or file_obj['Key'] > watermark:
+            watermark = file_obj['Key']
+    return watermark, frozenset(failed_keys)
+
+
+# Функция для получения списка файлов новых дней и новых файлов уже загруженных дней
+def list_new_files(s3_client, bucket_name, prefix, missing_days, open_days, compacted_prefix=None):
+    """open_days - {день: (последний загруженный ключ, ключи файлов с ошибками)}: для них листятся ключи
+    после watermark и повторяются файлы с ошибками.
+    Закрытые дни, для которых есть дневной раздел в compacted_prefix, читаются одним файлом раздела"""
+    compacted = {}
+    if compacted_prefix:
+        compacted = list_compacted_days(
+            s3_client, bucket_name, compacted_prefix, [day for day in missing_days if is_day_closed(day)]
+        )
+    raw_days = [day for day in missing_days if day not in compacted]
+
+    file_list, file_error = list_files_in_bucket(s3_client, bucket_name, prefix, days=raw_days)
+    file_list.extend(compacted.values())
+    for day, (last_key, failed_keys) in open_days.items():
+        if file_error:
+            break
+        # Файлы с ошибками могут лежать раньше watermark: тогда листим весь день (удаленные из S3 файлы
+        # в список не попадут и перестанут повторяться)
+        day_files, file_error = list_files_in_bucket(
+            s3_client, bucket_name, prefix, start_after=None if failed_keys else last_key, days=[day]
+        )
+        file_list.extend(
+            file_obj for file_obj in day_files
+            if file_obj['Key'] in failed_keys or last_key is None or file_obj['Key'] > last_key
+        )
+    return file_list, file_error
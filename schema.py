@@ -0,0 +1,94 @@
+import logging
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from diagnostics import timed
+
+logger = logging.getLogger('gift-dashboard')
+
+# Колонки, которые хранятся как категории (словарное кодирование):
+# file_name повторяется в каждой строке файла, UserId - плотные целые коды пользователей
+CATEGORY_COLUMNS = ['file_name', 'UserId']
+
+# Колонки с небольшими целыми значениями
+INT8_COLUMNS = ['Hour', 'InvoiceType']
+
+
+# Функция для приведения целой колонки к int8 (или Int8 при пропусках), если значения помещаются
+def to_int8(series):
+    values = pd.to_numeric(series, errors='coerce')
+    # Нечисловые значения не трогаем
+    if values.isna().sum() != series.isna().sum():
+        return series
+
+    non_null = values.dropna()
+    if non_null.empty or (non_null % 1 != 0).any():
+        return series
+    if non_null.min() < np.iinfo(np.int8).min or non_null.max() > np.iinfo(np.int8).max:
+        return series
+
+    return values.astype('Int8' if values.isna().any() else 'int8')
+
+
+# Функция для применения схемы к обработанному DataFrame файла
+def apply_schema(df):
+    """Приводит колонки к компактным типам: категории, int8, datetime64 для Date"""
+    for column in INT8_COLUMNS:
+        if column in df.columns:
+            df[column] = to_int8(df[column])
+
+    if 'Date' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['Date']):
+        df['Date'] = pd.to_datetime(df['Date'])
+
+    if 'Amount' in df.columns and not pd.api.types.is_numeric_dtype(df['Amount']):
+        df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce')
+
+    for column in CATEGORY_COLUMNS:
+        if column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+
+    return df
+
+
+# Функция для объединения DataFrame с сохранением категориальных колонок
+def concat_frames(frames):
+    """Как pd.concat(ignore_index=True), но категории объединяются, а не превращаются в object"""
+    frames = [df for df in frames if df is not None]
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0]
+
+    with timed('concat') as info:
+        columns = list(dict.fromkeys(column for df in frames for column in df.columns))
+        category_columns = [
+            column for column in columns
+            if all(column in df.columns and isinstance(df[column].dtype, pd.CategoricalDtype) for df in frames)
+        ]
+
+        unified = {}
+        for column in category_columns:
+            try:
+                unified[column] = union_categoricals([df[column] for df in frames])
+            except TypeError as e:
+                # Категории разных типов (например, числа и строки) - объединяем обычным образом
+                logger.warning(f"Не удалось объединить категории колонки {column}: {str(e)}")
+
+        combined = pd.concat(
+            [df.drop(columns=list(unified)) for df in frames] if unified else frames,
+            ignore_index=True
+        )
+        for column, values in unified.items():
+            combined[column] = values
+
+        info['rows'] = len(combined)
+        return combined[columns]
+
+
+# Функция для подсчета памяти, занимаемой DataFrame (в байтах)
+def frame_memory_usage(df):
+    if df is None:
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
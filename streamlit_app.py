@@ -1,16 +1,55 @@
 import streamlit as st
 import pandas as pd
-import boto3
+import altair as alt
 import json
 import os
-from datetime import datetime, timedelta
+import uuid
+from datetime import datetime, timezone
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import logging
-import re
+import multiprocessing
+import threading
 
-# Настройка логирования
+from s3_source import (
+    DEFAULT_MAX_WORKERS,
+    MIN_DATE,
+    connect_to_s3,
+    days_in_range,
+    default_compacted_prefix,
+    fetch_and_process_file,
+    is_pool_broken,
+    list_new_files,
+    load_files_concurrently,
+)
+from log_parsing import init_parse_worker
+from rollups import rollup_memory_usage
+from dataset_store import DEFAULT_MEMORY_LIMIT_MB, DatasetStore, build_partitions
+from live_tail import POLL_INTERVAL_SECONDS, join_live_tail, leave_live_tail, start_live_tail
+from metrics import (
+    SEGMENT_COHORT,
+    SEGMENT_INVOICE_TYPE,
+    SPIN_DEPTH,
+    compute_rollup_metrics,
+    segmented_spin_conversion,
+)
+from hll import DEFAULT_PRECISION
+from s3_cache import cache_path_for_key
+from duckdb_backend import compute_parquet_metrics, duckdb_available
+from diagnostics import DIAGNOSTICS, METRIC_STAGE_PREFIX, timed
+from activity_cube import HEATMAP_MEASURES, cube_heatmap, rolling_windows
+from explorer import PAGE_SIZE, explore_transactions
+from retention import (
+    RETENTION_ACTIVE,
+    RETENTION_PAYING,
+    bitmap_backend,
+    cohort_matrix,
+    retention_summary,
+)
+
+# Настройка логирования (подробные логи по каждому файлу - GIFT_DASHBOARD_LOG_LEVEL=DEBUG)
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('GIFT_DASHBOARD_LOG_LEVEL', 'INFO').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger('gift-dashboard')
@@ -27,11 +66,21 @@ st.set_page_config(
 st.title('🎁 Подарочный дашборд')
 st.markdown('Анализ данных транзакций из AWS S3 (начиная с 9 апреля 2025)')
 
-# Инициализация session_state для хранения данных
-if 'data' not in st.session_state:
-    st.session_state['data'] = None
-if 'combined_df' not in st.session_state:
-    st.session_state['combined_df'] = None
+# Инициализация session_state
+# Данные в сессии не хранятся: дневные разделы лежат в общем для сессий хранилище (см. get_dataset_store),
+# сырые строки - в локальном кэше и читаются по запросу
+# Версия (отпечаток) набора данных - ключ кэша метрик
+if 'dataset_version' not in st.session_state:
+    st.session_state['dataset_version'] = None
+# Клиент S3 после успешного подключения (нужен для ленивой догрузки дней)
+if 's3_client' not in st.session_state:
+    st.session_state['s3_client'] = None
+# Последний полностью выбранный период
+if 'date_range' not in st.session_state:
+    st.session_state['date_range'] = None
+# Идентификатор сессии для фоновой загрузки (поток работает, пока есть сессии с автообновлением)
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
 
 # Функция для получения AWS настроек из секретов Streamlit или пользовательского ввода
 def get_aws_settings():
@@ -59,6 +108,54 @@ aws_access_key, aws_secret_key, bucket_name, prefix = get_aws_settings()
 # Боковая панель для настроек
 st.sidebar.header('⚙️ Настройки подключения')
 
+# Количество параллельных загрузок (размер пула потоков и пула соединений S3)
+default_workers = DEFAULT_MAX_WORKERS
+if 'aws' in st.secrets:
+    default_workers = int(st.secrets['aws'].get('max_workers', DEFAULT_MAX_WORKERS))
+
+max_workers = int(st.sidebar.number_input(
+    'Параллельных загрузок',
+    min_value=1,
+    max_value=64,
+    value=default_workers,
+    help='Сколько файлов загружается и обрабатывается одновременно'
+))
+
+# Разбор JSON в отдельных процессах (0 - разбор в потоках загрузки)
+default_processes = 0
+if 'aws' in st.secrets:
+    default_processes = int(st.secrets['aws'].get('parse_processes', 0))
+
+parse_processes = int(st.sidebar.number_input(
+    'Процессов для разбора',
+    min_value=0,
+    max_value=max(os.cpu_count() or 1, 1) * 2,
+    value=default_processes,
+    help='0 - разбор в потоках загрузки; иначе JSON разбирается в пуле процессов на всех ядрах'
+))
+
+# Лимит памяти общего хранилища разделов - настройка процесса, а не сессии, поэтому только из Secrets
+store_memory_mb = DEFAULT_MEMORY_LIMIT_MB
+if 'aws' in st.secrets:
+    store_memory_mb = int(st.secrets['aws'].get('store_memory_mb', DEFAULT_MEMORY_LIMIT_MB))
+
+# Префикс дневных разделов compact.py: закрытые дни читаются одним файлом (пустая строка - не использовать)
+compacted_prefix = default_compacted_prefix(prefix)
+if 'aws' in st.secrets:
+    compacted_prefix = st.secrets['aws'].get('compacted_prefix', compacted_prefix)
+
+# Интервал фоновой проверки новых файлов (секунды) - тоже настройка процесса
+live_interval = POLL_INTERVAL_SECONDS
+if 'aws' in st.secrets:
+    live_interval = int(st.secrets['aws'].get('live_tail_seconds', POLL_INTERVAL_SECONDS))
+
+# Автообновление: новые 5-минутные файлы догружаются в фоне, дашборд перерисовывается по таймеру
+live_mode = st.sidebar.checkbox(
+    'Автообновление',
+    value=True,
+    help=f'Новые файлы загружаются в фоне, метрики обновляются каждые {live_interval} с без полной перезагрузки'
+)
+
 # Функция для сохранения настроек
 def save_settings():
     settings = {
@@ -90,397 +187,508 @@ if 'aws' not in st.secrets:
         status = save_settings()
         st.sidebar.success(status)
 
-# Функция для подключения к S3
-def connect_to_s3(aws_access_key, aws_secret_key):
-    try:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key
-        )
-        # Проверка подключения путем запроса списка бакетов
-        s3_client.list_buckets()
-        return s3_client, None
-    except Exception as e:
-        error_message = f"Ошибка подключения к AWS S3: {str(e)}"
-        logger.error(error_message)
-        return None, error_message
 
-# Функция для получения списка файлов в бакете (с поддержкой пагинации)
-def list_files_in_bucket(s3_client, bucket_name, prefix=''):
-    try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        page_iterator = paginator.paginate(Bucket=bucket_name, Prefix=prefix)
-
-        file_list = []
-        date_pattern = re.compile(r'(\d{4}-\d{2}-\d{2})')
-
-        for page in page_iterator:
-            if 'Contents' not in page:
-                continue
-
-            for obj in page['Contents']:
-                key = obj['Key']
-                if key.endswith('.json'):  # Используем расширение .json
-                    match = date_pattern.search(key)
-                    if match:
-                        file_date = match.group(1)
-                        if file_date >= "2025-04-09":
-                            file_list.append(key)
-
-        return file_list, None
-    except Exception as e:
-        error_message = f"Ошибка при получении списка файлов: {str(e)}"
-        logger.error(error_message)
-        return [], error_message
+# Функция для получения текущего пула процессов разбора (один на процесс приложения, общий для сессий)
+@st.cache_resource
+def get_parse_pool_state():
+    return {'pool': None, 'processes': None, 'lock': threading.Lock()}
 
+# Функция для получения пула процессов разбора
+def get_parse_pool(processes):
+    """При смене количества процессов прежний пул останавливается; пул, в котором процесс-обработчик
+    завершился аварийно (OOM, сигнал), заменяется новым"""
+    state = get_parse_pool_state()
+    with state['lock']:
+        pool = state['pool']
+        if pool is not None and (state['processes'] != processes or is_pool_broken(pool)):
+            pool.shutdown(wait=False, cancel_futures=True)
+            pool = None
+        if pool is None:
+            # fork, а не spawn: при spawn дочерний процесс заново выполнил бы скрипт приложения,
+            # который Streamlit регистрирует как __main__. Процессы только разбирают байты
+            pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context('fork'),
+                initializer=init_parse_worker
+            )
+            # С fork все процессы запускаются при первой задаче: запускаем их сразу, из потока скрипта,
+            # а не из потока загрузки, пока другие потоки загрузки держат блокировки
+            pool.submit(int).result()
+            state['pool'] = pool
+            state['processes'] = processes
+        return pool
 
-# Функция для загрузки файла из S3
-@st.cache_data
-def load_file_from_s3(_s3_client, bucket_name, file_key):
-    try:
-        response = _s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        file_content = response['Body'].read().decode('utf-8')
-        
-        # Пробуем сначала загрузить весь файл как один JSON
-        try:
-            # Пробуем загрузить весь файл как единый JSON
-            json_data = json.loads(file_content)
-            logger.info(f"Файл {file_key} загружен как единый JSON")
-            return json_data, None
-        except json.JSONDecodeError:
-            # Если не получилось, пробуем построчно
-            logger.info(f"Файл {file_key} не является единым JSON, пробуем построчно")
-            json_data = []
-            for line in file_content.strip().split('\n'):
-                if line:
-                    try:
-                        record = json.loads(line)
-                        json_data.append(record)
-                    except json.JSONDecodeError:
-                        logger.warning(f"Невозможно разобрать строку как JSON: {line}")
-            
-            if json_data:
-                logger.info(f"Файл {file_key} загружен построчно, найдено {len(json_data)} записей")
-                return json_data, None
-            else:
-                return None, f"Не удалось разобрать файл {file_key} как JSON"
-    except Exception as e:
-        error_message = f"Ошибка при загрузке файла {file_key}: {str(e)}"
-        logger.error(error_message)
-        return None, error_message
 
-# Функция для обработки данных JSON и преобразования в DataFrame
-def process_json_data(json_data, file_name):
-    try:
-        # Проверяем формат JSON-данных
-        if isinstance(json_data, list):
-            # Проверяем, есть ли данные
-            if not json_data or len(json_data) == 0:
-                return None, "Пустой список данных"
-            
-            # Проверяем формат первого элемента
-            first_item = json_data[0]
-            logger.info(f"Первый элемент в файле: {first_item}")
-            
-            # Если первый элемент - список, а не словарь
-            if isinstance(first_item, list):
-                # Преобразуем список списков в список словарей
-                logger.info("Обнаружен список списков, преобразуем в словари")
-                
-                # Предполагаем, что в первой строке заголовки столбцов
-                if len(json_data) > 1:
-                    # Используем первый список как заголовки
-                    headers = json_data[0]
-                    # Преобразуем остальные списки в словари
-                    data_dicts = [dict(zip(headers, row)) for row in json_data[1:]]
-                    df = pd.DataFrame(data_dicts)
-                else:
-                    # Если только один список, создаем пустой DataFrame
-                    return None, "Файл содержит только заголовки без данных"
-            else:
-                # Стандартный список словарей
-                try:
-                    logger.info(f"Ключи в первой записи: {list(first_item.keys())}")
-                    df = pd.DataFrame(json_data)
-                except (AttributeError, TypeError) as e:
-                    # Если элементы не словари, пробуем преобразовать их
-                    logger.error(f"Ошибка при обработке данных: {e}")
-                    logger.info(f"Пробуем обработать как простые значения")
-                    
-                    # Пробуем создать DataFrame с одним столбцом
-                    df = pd.DataFrame({
-                        'Value': json_data,
-                        'UserId': range(len(json_data)),  # Создаем уникальные ID
-                        'InvoiceType': 0,  # Заглушка
-                        'Amount': 0  # Заглушка
-                    })
-            
-            # Логируем колонки DataFrame
-            logger.info(f"Колонки в DataFrame: {df.columns.tolist() if not df.empty else '[пусто]'}")
-            
-            # Пропускаем записи с TestMode=true
-            if 'TestMode' in df.columns:
-                df = df[df['TestMode'] != True]
-            
-            # Добавляем имя файла к каждой записи
-            df['file_name'] = file_name
-            
-            # Если есть временная метка, преобразуем её в читаемую дату
-            if 'Timestamp' in df.columns:
-                df['Datetime'] = pd.to_datetime(df['Timestamp'], unit='s')
-                # Добавляем колонки с часом и днем для анализа
-                df['Hour'] = df['Datetime'].dt.hour
-                df['Date'] = df['Datetime'].dt.date
-            else:
-                # Если нет временной метки, используем дату из имени файла
-                date_match = re.search(r'(\d{4}-\d{2}-\d{2})', file_name)
-                if date_match:
-                    file_date = date_match.group(1)
-                    df['Date'] = pd.to_datetime(file_date)
-                    
-                    # Извлекаем час из имени файла
-                    hour_match = re.search(r'\d{4}-\d{2}-\d{2}-(\d{2})-\d{2}', file_name)
-                    hour = int(hour_match.group(1)) if hour_match else 0
-                    df['Hour'] = hour
-            
-            # Добавляем необходимые поля, если их нет
-            if 'UserId' not in df.columns:
-                df['UserId'] = range(len(df))  # Создаем уникальные ID
-            
-            if 'InvoiceType' not in df.columns:
-                df['InvoiceType'] = 0  # Заглушка
-                
-            if 'Amount' not in df.columns:
-                df['Amount'] = 0  # Заглушка
-            
-            return df, None
-        else:
-            error_message = f"Неожиданный формат данных в файле {file_name}: Данные не являются списком JSON-объектов"
-            logger.error(error_message)
-            return None, error_message
-    except Exception as e:
-        error_message = f"Ошибка при обработке данных из файла {file_name}: {str(e)}"
-        logger.error(error_message)
-        return None, error_message
-
-# Функция для подготовки данных по дням для графика всех пользователей
-@st.cache_data(ttl=3600)
-def prepare_users_daily_data(df):
-    """Подготавливает данные для графика по дням с количеством уникальных пользователей"""
-    if df is None or df.empty:
-        return None
-    
-    try:
-        # Убедимся, что даты в правильном формате
-        df_copy = df.copy()
-        if not pd.api.types.is_datetime64_any_dtype(df_copy['Date']):
-            df_copy['Date'] = pd.to_datetime(df_copy['Date'])
-        
-        # Считаем уникальных пользователей по дням
-        users_by_day = df_copy.groupby('Date')['UserId'].nunique().reset_index()
-        users_by_day.columns = ['Date', 'Уникальные пользователи']
-        users_by_day = users_by_day.sort_values('Date')
-        
-        return users_by_day
-    except Exception as e:
-        st.error(f"Ошибка при подготовке данных по пользователям: {str(e)}")
-        return None
+# Функция для расчета метрик дашборда
+# Кэш привязан к версии набора данных: DataFrame не хешируется при каждом вызове
+@st.cache_data(ttl=3600, max_entries=16)
+def get_dashboard_metrics(dataset_version, approximate, hll_precision, spin_depth, _rollup):
+    """Рассчитывает все метрики дашборда из объединенного агрегата"""
+    return compute_rollup_metrics(
+        _rollup, approximate=approximate, precision=hll_precision, spin_depth=spin_depth
+    )
+
+# Функция для расчета воронки по спинам с разбивкой на сегменты
+@st.cache_data(ttl=3600, max_entries=16)
+def get_segmented_funnel(dataset_version, spin_depth, segment_by, _rollup):
+    return segmented_spin_conversion(_rollup, depth=spin_depth, segment_by=segment_by)
+
+# Функция для расчета метрик SQL-запросами DuckDB по Parquet-файлам локального кэша
+@st.cache_data(ttl=3600, max_entries=16)
+def get_parquet_metrics(dataset_version, spin_depth, start_day, end_day, _paths):
+    return compute_parquet_metrics(_paths, start_day, end_day, spin_depth)
+
+# Функция для расчета тепловых карт час × день и скользящих окон по кубу активности
+# Работа зависит от числа дней периода, а не от числа строк
+@st.cache_data(ttl=3600, max_entries=16)
+def get_activity_views(dataset_version, _rollup):
+    cube = _rollup.get('cube')
+    if cube is None:
+        return None, None
+    with timed(f"{METRIC_STAGE_PREFIX}activity_cube"):
+        heatmaps = {measure: cube_heatmap(cube, measure) for measure in HEATMAP_MEASURES}
+        return heatmaps, rolling_windows(cube)
+
+# Функция для расчета удержания и матрицы когорт по битовым картам пользователей дней периода
+@st.cache_data(ttl=3600, max_entries=16)
+def get_retention(dataset_version, kind, _day_bitmaps):
+    with timed(f"{METRIC_STAGE_PREFIX}retention", kind=kind):
+        return retention_summary(_day_bitmaps, kind), cohort_matrix(_day_bitmaps, kind)
 
-# Функция для подготовки данных по дням для графика платящих пользователей
-@st.cache_data(ttl=3600)
-def prepare_paying_users_daily_data(df):
-    """Подготавливает данные для графика по дням с количеством платящих пользователей"""
-    if df is None or df.empty:
+# Функция для получения путей к Parquet-файлам периода в локальном кэше
+def cached_parquet_paths(days):
+    """Возвращает список путей или None, если какого-то файла в кэше нет (тогда считаем по агрегатам)"""
+    partitions = get_dataset_store(bucket_name, prefix).get_partitions(days)
+    paths = [
+        cache_path_for_key(file_obj['Key'])
+        for day in days if day in partitions
+        for file_obj in partitions[day]['files']
+    ]
+    if not paths or not all(path.exists() for path in paths):
         return None
+    return [str(path) for path in paths]
+
+
+# Функция для загрузки списка файлов с прогресс-баром и выводом ошибок
+def ingest_files(s3_client, bucket_name, file_list, max_workers):
+    """Возвращает (агрегаты по ключам файлов, множество успешно обработанных ключей)"""
+    # Отображаем прогресс-бар для загрузки файлов
+    progress_bar = st.progress(0)
+    status_text = st.empty()
     
-    try:
-        # Убедимся, что даты в правильном формате
-        df_copy = df.copy()
-        if not pd.api.types.is_datetime64_any_dtype(df_copy['Date']):
-            df_copy['Date'] = pd.to_datetime(df_copy['Date'])
+    # Загружаем и обрабатываем файлы параллельно, результаты приходят по мере готовности
+    parse_pool = get_parse_pool(parse_processes) if parse_processes else None
+    loaded_rollups = {}
+    ok_keys = set()
+    cache_hits = 0
+    
+    for done, (i, file_key, rollup, error, cache_hit) in enumerate(
+        load_files_concurrently(s3_client, bucket_name, file_list, max_workers, parse_pool), start=1
+    ):
+        # Обновляем прогресс
+        progress_bar.progress(done / len(file_list))
+        status_text.text(f"Обработано файлов {done} из {len(file_list)}: {file_key}")
         
-        # Фильтруем только оплаченные транзакции (InvoiceType = 1)
-        paying_df = df_copy[df_copy['InvoiceType'] == 1]
+        if error:
+            st.error(error)
+            continue
         
-        # Считаем уникальных платящих пользователей по дням
-        paying_users_by_day = paying_df.groupby('Date')['UserId'].nunique().reset_index()
-        paying_users_by_day.columns = ['Date', 'Платящие пользователи']
-        paying_users_by_day = paying_users_by_day.sort_values('Date')
+        ok_keys.add(file_key)
+        cache_hits += cache_hit
         
-        return paying_users_by_day
-    except Exception as e:
-        st.error(f"Ошибка при подготовке данных по платящим пользователям: {str(e)}")
-        return None
+        if rollup is not None:
+            loaded_rollups[file_key] = rollup
+    
+    # Очищаем прогресс и статус
+    progress_bar.empty()
+    status_text.empty()
+    
+    if cache_hits:
+        st.info(f"Из локального кэша загружено файлов: {cache_hits} из {len(file_list)}")
+    
+    return loaded_rollups, ok_keys
 
-# Функция для расчета конверсии по номеру спина
-@st.cache_data(ttl=3600)
-def calculate_spin_conversion(df):
-    """Рассчитывает конверсию пользователей по номеру спина"""
-    if df is None or df.empty:
-        return None
+# Функция для получения общего для всех сессий хранилища разделов бакета и префикса
+@st.cache_resource
+def get_dataset_store(bucket_name, prefix):
+    return DatasetStore(store_memory_mb)
+
+# Лимит памяти из настроек применяется и к уже созданному хранилищу
+get_dataset_store(bucket_name, prefix).set_memory_limit(store_memory_mb)
+
+# Функция для получения фонового потока догрузки новых файлов (один на хранилище, общий для сессий)
+@st.cache_resource
+def get_live_tail(bucket_name, prefix, _s3_client):
+    return start_live_tail(get_dataset_store(bucket_name, prefix), _s3_client, bucket_name, prefix, live_interval)
+
+# Функция для загрузки недостающих дней периода и догрузки новых файлов в незакрытые дни
+def sync_partitions(s3_client, days, refresh_open=False):
+    """Обновляет разделы в общем хранилище и возвращает количество обработанных файлов.
+    Дни, которые уже загружает другая сессия, не загружаются повторно - ожидаем их"""
+    store = get_dataset_store(bucket_name, prefix)
+    partitions = store.get_partitions(days)
+    stale_days = [day for day in days if day not in partitions]
+    stale_days += [day for day in days if refresh_open and day in partitions and not partitions[day]['closed']]
+    
+    # Суженный или уже загруженный период не требует обращений к S3
+    if not stale_days:
+        return 0
     
+    claimed_days, waiting = store.claim(stale_days)
     try:
-        # Фильтруем только оплаченные транзакции (InvoiceType = 1)
-        paying_df = df[df['InvoiceType'] == 1]
-        
-        # Получаем общее количество уникальных пользователей
-        total_users = df['UserId'].nunique()
-        
-        # Группируем транзакции по пользователям и считаем количество оплат для каждого
-        user_payments = paying_df.groupby('UserId').size().reset_index(name='PaymentCount')
-        
-        # Создаем DataFrame для конверсии
-        conversion_data = []
-        
-        # Рассчитываем конверсию для каждого спина (от 1 до 10)
-        for spin_num in range(1, 11):
-            # Количество пользователей, которые сделали хотя бы spin_num оплат
-            users_with_spins = user_payments[user_payments['PaymentCount'] >= spin_num].shape[0]
-            
-            # Рассчитываем процент конверсии
-            conversion_rate = (users_with_spins / total_users * 100) if total_users > 0 else 0
-            
-            conversion_data.append({
-                'Номер спина': spin_num,
-                'Количество пользователей': users_with_spins,
-                'Процент конверсии': round(conversion_rate, 2)
-            })
-        
-        return pd.DataFrame(conversion_data)
-    except Exception as e:
-        st.error(f"Ошибка при расчете конверсии по спинам: {str(e)}")
-        return None
+        if waiting:
+            with st.spinner('Данные загружаются в другой сессии...'):
+                for event in waiting:
+                    event.wait()
+        if not claimed_days:
+            return 0
+        return load_partitions(s3_client, store, claimed_days, pinned=days)
+    finally:
+        store.release(claimed_days)
+
+# Функция для загрузки дней, захваченных сессией, в общее хранилище
+def load_partitions(s3_client, store, days, pinned=()):
+    """Новые дни загружаются целиком, уже загруженные (незакрытые) - с последнего загруженного ключа
+    и с повтором файлов, которые не удалось загрузить"""
+    partitions = store.get_partitions(days)
+    missing_days = [day for day in days if day not in partitions]
+    open_days = {day: (partitions[day]['last_key'], partitions[day]['failed']) for day in days if day in partitions}
+    
+    with st.spinner('Получение списка файлов...'):
+        file_list, file_error = list_new_files(
+            s3_client, bucket_name, prefix, missing_days, open_days, compacted_prefix
+        )
+    
+    if file_error:
+        st.error(file_error)
+        return 0
+    
+    if file_list:
+        st.success(f"Найдено файлов: {len(file_list)}")
+        loaded_rollups, ok_keys = ingest_files(s3_client, bucket_name, file_list, max_workers)
+        if not loaded_rollups and len(ok_keys) < len(file_list):
+            st.error("Не удалось загрузить данные из файлов")
+    else:
+        loaded_rollups, ok_keys = {}, set()
+    
+    store.publish(build_partitions(days, partitions, file_list, loaded_rollups, ok_keys), pinned=pinned)
+    return len(file_list)
+
+# Функция для сборки агрегата выбранного периода из дневных разделов общего хранилища
+def build_combined_rollup(days):
+    dataset_version, combined_rollup = get_dataset_store(bucket_name, prefix).combined_rollup(days)
+    st.session_state['dataset_version'] = dataset_version
+    return combined_rollup
+
+# Функция для чтения страницы сырых транзакций периода (из локального кэша, при промахе - из S3)
+def load_explorer_page(s3_client, days, filters, cursor, page_size):
+    """Файлы пользователя находятся по индексу разделов, остальные фильтры применяются к строкам файлов;
+    читается ровно столько файлов, сколько нужно для страницы"""
+    # Функция для чтения одного файла с выводом ошибки
+    def load_frame(file_obj):
+        df, error, _ = fetch_and_process_file(s3_client, bucket_name, file_obj)
+        if error:
+            st.error(error)
+        return df
+    
+    partitions = get_dataset_store(bucket_name, prefix).get_partitions(days)
+    with timed('explorer', user_filter=bool(filters['user_id'])) as info:
+        page = explore_transactions(partitions, days, load_frame, filters, cursor, page_size)
+        info['rows'] = len(page[0]) if page[0] is not None else 0
+    return page
+
+# Функция для отображения постраничного просмотра сырых транзакций с фильтрами
+def render_transaction_explorer(days, combined_rollup):
+    col1, col2 = st.columns(2)
+    user_id = col1.text_input('UserId', key='explorer_user_id').strip()
+    file_filter = col2.text_input('Файл (часть ключа)', key='explorer_file').strip()
+    
+    col1, col2 = st.columns(2)
+    first_day, last_day = (datetime.strptime(day, '%Y-%m-%d').date() for day in (days[0], days[-1]))
+    explorer_dates = col1.date_input(
+        'Даты',
+        value=(first_day, last_day),
+        min_value=first_day,
+        max_value=last_day,
+        key='explorer_dates'
+    )
+    # Пока выбрана только начальная дата, конец диапазона - последний день периода
+    explorer_dates = tuple(explorer_dates) if isinstance(explorer_dates, (list, tuple)) else (explorer_dates,)
+    date_from = explorer_dates[0] if explorer_dates else first_day
+    date_to = explorer_dates[1] if len(explorer_dates) > 1 else last_day
+    user_types = combined_rollup['user_types']
+    invoice_types = col2.multiselect(
+        'InvoiceType',
+        options=sorted(int(value) for value in user_types['InvoiceType'].dropna().unique()),
+        key='explorer_invoice_types'
+    )
+    
+    col1, col2, col3 = st.columns(3)
+    amount_min = col1.number_input('Сумма от', value=None, step=1.0, key='explorer_amount_min')
+    amount_max = col2.number_input('Сумма до', value=None, step=1.0, key='explorer_amount_max')
+    page_size = col3.selectbox('Строк на странице', options=[10, PAGE_SIZE, 100, 500], index=1, key='explorer_page_size')
+    
+    filters = {
+        'user_id': user_id or None,
+        'file': file_filter or None,
+        # Диапазон, совпадающий с периодом, не ограничивает строки (в том числе строки без даты)
+        'date_from': date_from if date_from != first_day else None,
+        'date_to': date_to if date_to != last_day else None,
+        'invoice_types': invoice_types,
+        'amount_min': amount_min,
+        'amount_max': amount_max,
+    }
+    
+    # При смене фильтров просмотр начинается с первой страницы. Курсоры начала открытых страниц хранятся,
+    # чтобы листать назад без повторного поиска; они ссылаются на ключи файлов, поэтому публикация новых
+    # файлов (живое обновление) не сбрасывает просмотр - перечитывается только текущая страница
+    query = (tuple(days), page_size, json.dumps(filters, default=str))
+    if st.session_state.get('explorer_query') != query:
+        st.session_state['explorer_query'] = query
+        st.session_state['explorer_cursors'] = [None]
+        st.session_state['explorer_page_number'] = 0
+        st.session_state['explorer_page'] = None
+    page_number = st.session_state['explorer_page_number']
+    
+    cached_page = st.session_state['explorer_page']
+    page_key = (st.session_state['dataset_version'], page_number)
+    if cached_page is None or cached_page[0] != page_key:
+        try:
+            page = load_explorer_page(
+                st.session_state['s3_client'], days, filters, st.session_state['explorer_cursors'][page_number], page_size
+            )
+        except LookupError:
+            # Файла, с которого начиналась страница, больше нет (день сжат) - начинаем сначала
+            page_number = st.session_state['explorer_page_number'] = 0
+            st.session_state['explorer_cursors'] = [None]
+            page = load_explorer_page(st.session_state['s3_client'], days, filters, None, page_size)
+            page_key = (st.session_state['dataset_version'], page_number)
+        st.session_state['explorer_page'] = (page_key, page)
+        # Следующие страницы могли измениться вместе с данными - их курсоры считаются заново
+        next_cursor = page[1]
+        st.session_state['explorer_cursors'] = (
+            st.session_state['explorer_cursors'][:page_number + 1] + ([next_cursor] if next_cursor is not None else [])
+        )
+    page_df, next_cursor, candidate_count, files_read = st.session_state['explorer_page'][1]
+    
+    if page_df is None or page_df.empty:
+        st.info('Нет транзакций по выбранным фильтрам')
+    elif check_required_fields(page_df):
+        st.dataframe(page_df, hide_index=True, use_container_width=True)
+    
+    # Функция для перехода на другую страницу (выполняется до перезапуска)
+    def change_page(step):
+        st.session_state['explorer_page_number'] += step
+    
+    col1, col2, col3 = st.columns([1, 1, 4])
+    col1.button('← Назад', disabled=page_number == 0, on_click=change_page, args=(-1,), key='explorer_prev')
+    col2.button('Далее →', disabled=next_cursor is None, on_click=change_page, args=(1,), key='explorer_next')
+    col3.caption(
+        f"Страница {page_number + 1}; файлов-кандидатов: {candidate_count:,}, прочитано для страницы: {files_read:,}"
+        + (' (файлы пользователя найдены по индексу)' if user_id else '')
+    )
+
+# Функция для проверки наличия необходимых полей (с выводом отладочной информации)
+def check_required_fields(df):
+    required_fields = ['UserId', 'InvoiceType', 'Amount']
+    missing_fields = [field for field in required_fields if field not in df.columns]
+    
+    if missing_fields:
+        st.error(f"В данных отсутствуют необходимые поля: {', '.join(missing_fields)}")
+        st.write("Доступные поля в данных:")
+        st.write(df.columns.tolist())
+        # Показываем пример данных для отладки
+        st.write("Пример данных:")
+        st.write(df.head(1).to_dict('records'))
+        return False
+    return True
+
+# Выбор периода: границы передаются в листинг S3, загружаются только нужные дни
+st.sidebar.header('📅 Период')
+today = datetime.now(timezone.utc).date()
+date_range = st.sidebar.date_input(
+    'Период данных',
+    value=(MIN_DATE, today),
+    min_value=MIN_DATE,
+    max_value=today,
+    key='date_range_input'
+)
+if isinstance(date_range, (tuple, list)) and len(date_range) == 2:
+    st.session_state['date_range'] = tuple(date_range)
+else:
+    # Пока выбрана только начальная дата, используем предыдущий период
+    st.sidebar.caption('Выберите конечную дату периода')
+start_date, end_date = st.session_state['date_range'] or (MIN_DATE, today)
+selected_days = days_in_range(start_date, end_date)
+
+# Приближенный режим: уникальные пользователи оцениваются по скетчам HyperLogLog дней периода
+approximate_mode = st.sidebar.checkbox(
+    'Приближенный подсчет пользователей',
+    value=False,
+    help='Уникальные пользователи считаются только по скетчам HyperLogLog - быстро на длинных периодах, '
+         'с небольшой погрешностью; конверсия по спинам в этом режиме не рассчитывается'
+)
+hll_precision = DEFAULT_PRECISION
+if approximate_mode:
+    # Скетчи строятся с точностью DEFAULT_PRECISION и при расчете могут быть понижены
+    hll_precision = st.sidebar.select_slider(
+        'Точность HyperLogLog',
+        options=list(range(8, DEFAULT_PRECISION + 1)),
+        value=DEFAULT_PRECISION,
+        format_func=lambda p: f"{p} (±{1.04 / (1 << p) ** 0.5:.1%})",
+        help='Число регистров скетча - 2^p; больше - точнее'
+    )
+
+# Движок расчета метрик: агрегаты в памяти или SQL по Parquet-файлам на диске
+# (альтернативный путь расчета; агрегаты в памяти нужны остальным разделам дашборда и строятся всегда)
+METRICS_BACKENDS = {
+    'pandas': 'pandas (агрегаты в памяти)',
+    'duckdb': 'DuckDB (SQL по Parquet в кэше)',
+}
+metrics_backend = 'pandas'
+if duckdb_available():
+    metrics_backend = st.sidebar.selectbox(
+        'Движок расчета метрик',
+        options=list(METRICS_BACKENDS),
+        format_func=METRICS_BACKENDS.get,
+        help='DuckDB пересчитывает основные метрики и воронку SQL-запросами по файлам локального кэша - '
+             'другой способ расчета тех же чисел. Память он не экономит: агрегаты дней и периода строятся '
+             'при загрузке в любом случае. Приближенный режим в нем не используется'
+    )
+
+# Настройки воронки по спинам
+st.sidebar.header('🎰 Воронка по спинам')
+spin_depth = int(st.sidebar.number_input(
+    'Глубина воронки (спинов)',
+    min_value=1,
+    max_value=1000,
+    value=SPIN_DEPTH,
+    help='До какого номера спина считать конверсию'
+))
+SEGMENT_OPTIONS = {
+    None: 'Без разбивки',
+    SEGMENT_COHORT: 'По когорте (день первого появления)',
+    SEGMENT_INVOICE_TYPE: 'По типу счета (InvoiceType)',
+}
+segment_by = st.sidebar.selectbox(
+    'Разбивка воронки',
+    options=list(SEGMENT_OPTIONS),
+    format_func=SEGMENT_OPTIONS.get
+)
 
 # Основной раздел приложения
 st.header('📂 Данные из AWS S3')
 
+load_clicked = st.button('Подключиться к AWS и получить данные')
+
+# Инкрементальное обновление доступно после подключения
+refresh_clicked = False
+if st.session_state['s3_client'] is not None:
+    refresh_clicked = st.button(
+        'Загрузить только новые файлы',
+        help='Догружает новые файлы за незакрытые дни выбранного периода'
+    )
+
 # Кнопка для подключения к S3 или сброса данных
-if st.button('Подключиться к AWS и получить данные'):
-    # Сбрасываем данные в session_state
-    st.session_state['data'] = None
-    st.session_state['combined_df'] = None
+processed = 0
+if load_clicked:
+    # Сбрасываем подключение сессии; уже загруженные в общее хранилище дни используются повторно
+    st.session_state['s3_client'] = None
     
     # Подключение к S3
     with st.spinner('Подключение к AWS S3...'):
-        s3_client, connection_error = connect_to_s3(aws_access_key, aws_secret_key)
+        s3_client, connection_error = connect_to_s3(aws_access_key, aws_secret_key, max_workers)
     
     if connection_error:
         st.error(connection_error)
     else:
         st.success('Подключение к AWS S3 успешно!')
+        st.session_state['s3_client'] = s3_client
         
-        # Получаем список файлов
-        with st.spinner('Получение списка файлов...'):
-            file_list, file_error = list_files_in_bucket(s3_client, bucket_name, prefix)
-        
-        if file_error:
-            st.error(file_error)
-        elif not file_list:
-            st.warning(f"Не найдено файлов в бакете {bucket_name} с префиксом {prefix} начиная с 9 апреля 2025")
-        else:
-            st.success(f"Найдено {len(file_list)} файлов")
-            
-            # Отображаем прогресс-бар для загрузки файлов
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            # Загружаем и обрабатываем файлы
-            all_dataframes = []
-            
-            for i, file_key in enumerate(file_list):
-                # Обновляем прогресс
-                progress = (i + 1) / len(file_list)
-                progress_bar.progress(progress)
-                status_text.text(f"Обработка файла {i+1} из {len(file_list)}: {file_key}")
-                
-                # Загружаем файл
-                json_data, load_error = load_file_from_s3(s3_client, bucket_name, file_key)
-                
-                if load_error:
-                    st.error(f"Ошибка при загрузке {file_key}: {load_error}")
-                    continue
-                
-                # Обрабатываем данные
-                df, process_error = process_json_data(json_data, file_key)
-                
-                if process_error:
-                    st.error(f"Ошибка при обработке {file_key}: {process_error}")
-                    continue
-                
-                if df is not None and not df.empty:
-                    all_dataframes.append(df)
-            
-            # Очищаем прогресс и статус
-            progress_bar.empty()
-            status_text.empty()
-            
-            if not all_dataframes:
-                st.error("Не удалось загрузить данные из файлов")
-            else:
-                # Объединяем все DataFrame
-                combined_df = pd.concat(all_dataframes, ignore_index=True)
-                
-                # Проверяем наличие необходимых полей
-                required_fields = ['UserId', 'InvoiceType', 'Amount']
-                missing_fields = [field for field in required_fields if field not in combined_df.columns]
-                
-                if missing_fields:
-                    st.error(f"В данных отсутствуют необходимые поля: {', '.join(missing_fields)}")
-                    st.write("Доступные поля в данных:")
-                    st.write(combined_df.columns.tolist())
-                    # Показываем пример данных для отладки
-                    st.write("Пример данных:")
-                    st.write(combined_df.head(1).to_dict('records'))
-                else:
-                    # Сохраняем в session_state
-                    st.session_state['data'] = combined_df
-                    st.session_state['combined_df'] = combined_df
-                    
-                    st.success(f"Данные успешно загружены! Всего записей: {combined_df.shape[0]}")
-
-# Если данные загружены, отображаем их
-if st.session_state['combined_df'] is not None:
-    combined_df = st.session_state['combined_df']
-    
-    # Отображаем предварительный просмотр данных
-    st.subheader('Предварительный просмотр данных')
-    st.dataframe(combined_df.head(10), use_container_width=True)
+        processed = sync_partitions(s3_client, selected_days)
+        if build_combined_rollup(selected_days) is None:
+            st.warning(f"Не найдено файлов в бакете {bucket_name} с префиксом {prefix} за период {start_date} — {end_date}")
+
+elif st.session_state['s3_client'] is not None:
+    # Ленивая догрузка: при расширении периода загружаются только недостающие дни,
+    # по кнопке обновления - еще и новые файлы незакрытых дней
+    processed = sync_partitions(st.session_state['s3_client'], selected_days, refresh_open=refresh_clicked)
+    if refresh_clicked and not processed:
+        st.info('Новых файлов нет')
+
+# Сессия без подключения не видит данные, загруженные в общее хранилище другими сессиями
+combined_rollup = build_combined_rollup(selected_days) if st.session_state['s3_client'] is not None else None
+if combined_rollup is not None and processed:
+    st.success(f"Данные успешно загружены! Всего записей: {combined_rollup['rows']}")
+
+# Функция для отображения дашборда по текущей опубликованной версии данных
+def render_dashboard(days):
+    combined_rollup = build_combined_rollup(days)
+    # Если данные не загружены, отображать нечего
+    if combined_rollup is None:
+        return
+    
+    # Просмотр сырых транзакций: строки читаются только для видимой страницы
+    st.subheader('Транзакции')
+    render_transaction_explorer(days, combined_rollup)
+    store = get_dataset_store(bucket_name, prefix)
+    st.caption(
+        f"Записей: {combined_rollup['rows']:,}, "
+        f"память агрегатов: {rollup_memory_usage(combined_rollup) / 1024 ** 2:,.1f} МБ, "
+        f"общее хранилище: {store.memory_usage() / 1024 ** 2:,.1f} из {store_memory_mb:,} МБ"
+        + (f", обновлено: {store.published_at:%H:%M:%S} UTC" if store.published_at else '')
+    )
+    
+    # Рассчитываем все метрики за один проход (из кэша, если версия данных не изменилась)
+    dashboard_metrics = None
+    if metrics_backend == 'duckdb':
+        paths = cached_parquet_paths(days)
+        try:
+            if paths is not None:
+                dashboard_metrics = get_parquet_metrics(
+                    st.session_state['dataset_version'], spin_depth, days[0], days[-1], paths
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось рассчитать метрики в DuckDB: {str(e)}")
+        if dashboard_metrics is None:
+            st.caption('Метрики рассчитаны по агрегатам в памяти: Parquet-файлы периода недоступны для DuckDB')
+    try:
+        if dashboard_metrics is None:
+            dashboard_metrics = get_dashboard_metrics(
+                st.session_state['dataset_version'], approximate_mode, hll_precision, spin_depth, combined_rollup
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при расчете метрик: {str(e)}")
+        st.error(f"Ошибка при расчете метрик: {str(e)}")
+        dashboard_metrics = {}
     
     # Отображаем основные метрики
     st.subheader('Основные метрики')
     
     col1, col2, col3 = st.columns(3)
     
-    # Проверяем наличие необходимых полей перед расчетом метрик
-    if 'UserId' in combined_df.columns:
-        # Общее количество уникальных пользователей
-        total_users = combined_df['UserId'].nunique()
+    # В приближенном режиме количества пользователей помечаются как оценки
+    estimate_mark = '≈ ' if dashboard_metrics.get('approximate') else ''
+    if dashboard_metrics:
         with col1:
-            st.metric("Всего пользователей", total_users)
-    
-    if 'UserId' in combined_df.columns and 'InvoiceType' in combined_df.columns:
-        # Количество платящих пользователей
-        paying_users = combined_df[combined_df['InvoiceType'] == 1]['UserId'].nunique()
-        with col2:
-            st.metric("Платящих пользователей", paying_users)
-    else:
+            st.metric("Всего пользователей", f"{estimate_mark}{dashboard_metrics['total_users']}")
         with col2:
-            st.metric('Платящих пользователей', "Нет данных")
-    
-    if 'InvoiceType' in combined_df.columns and 'Amount' in combined_df.columns:
-        # Сумма транзакций
-        total_deposits = combined_df[combined_df['InvoiceType'] == 1]['Amount'].sum()
-    with col3:
-        st.metric('Сумма транзакций (старс)', f"{total_deposits:,.2f}")
+            st.metric("Платящих пользователей", f"{estimate_mark}{dashboard_metrics['paying_users']}")
+        with col3:
+            st.metric('Сумма транзакций (старс)', f"{dashboard_metrics['total_deposits']:,.2f}")
+        if dashboard_metrics.get('approximate'):
+            st.caption(
+                f"≈ Оценка HyperLogLog, стандартная ошибка ±{dashboard_metrics['relative_error'] or 0:.1%}. "
+                "Сумма транзакций считается точно."
+            )
     
-    # Подготавливаем данные для графиков
-    users_daily_data = prepare_users_daily_data(combined_df)
-    paying_users_daily_data = prepare_paying_users_daily_data(combined_df)
-    spin_conversion_data = calculate_spin_conversion(combined_df)
+    # Данные для графиков
+    users_daily_data = dashboard_metrics.get('users_daily')
+    paying_users_daily_data = dashboard_metrics.get('paying_users_daily')
+    spin_conversion_data = dashboard_metrics.get('spin_conversion')
     
     # График всех пользователей
-    st.subheader('График всех пользователей по дням')
+    st.subheader(f"График всех пользователей по дням{' (оценка)' if estimate_mark else ''}")
     if users_daily_data is not None and not users_daily_data.empty:
         # Преобразуем даты в строки для корректного отображения
         # Проверяем тип данных в колонке Date
@@ -497,7 +705,7 @@ if st.session_state['combined_df'] is not None:
         st.info('Нет данных для отображения графика пользователей')
     
     # График платящих пользователей
-    st.subheader('График платящих пользователей по дням')
+    st.subheader(f"График платящих пользователей по дням{' (оценка)' if estimate_mark else ''}")
     if paying_users_daily_data is not None and not paying_users_daily_data.empty:
         # Преобразуем даты в строки для корректного отображения
         # Проверяем тип данных в колонке Date
@@ -515,10 +723,157 @@ if st.session_state['combined_df'] is not None:
     
     # Таблица конверсии по номеру спина
     st.subheader('Конверсия по номеру спина')
-    if spin_conversion_data is not None and not spin_conversion_data.empty:
+    if dashboard_metrics.get('approximate'):
+        # Воронке нужны точные количества оплат каждого пользователя - приближенный режим их не читает
+        st.info('В приближенном режиме конверсия по спинам не рассчитывается: отключите приближенный подсчет')
+    elif segment_by is not None:
+        funnel_data = get_segmented_funnel(st.session_state['dataset_version'], spin_depth, segment_by, combined_rollup)
+        if funnel_data is not None and not funnel_data.empty:
+            # Сегменты - колонки, строки - номер спина, значения - процент конверсии
+            funnel_data['Сегмент'] = funnel_data['Сегмент'] + ' (n=' + funnel_data['Размер сегмента'].astype(str) + ')'
+            st.dataframe(
+                funnel_data.pivot(index='Номер спина', columns='Сегмент', values='Процент конверсии'),
+                use_container_width=True
+            )
+            if segment_by == SEGMENT_INVOICE_TYPE:
+                st.caption('Для каждого типа счета: доля всех пользователей, сделавших хотя бы N транзакций этого типа, %')
+            else:
+                st.caption('Доля пользователей когорты, сделавших хотя бы N оплат, %')
+        else:
+            st.info('Нет данных для расчета конверсии по спинам')
+    elif spin_conversion_data is not None and not spin_conversion_data.empty:
         st.table(spin_conversion_data)
     else:
         st.info('Нет данных для расчета конверсии по спинам')
+    
+    # Удержание: когорты и D1/D7/D30 - пересечения битовых карт пользователей по дням
+    st.subheader('Удержание по когортам')
+    RETENTION_KINDS = {
+        RETENTION_ACTIVE: 'Активные (когорта - первый день активности)',
+        RETENTION_PAYING: 'Платящие (когорта - день первой оплаты)',
+    }
+    retention_kind = st.radio(
+        'Удержание',
+        options=list(RETENTION_KINDS),
+        format_func=RETENTION_KINDS.get,
+        horizontal=True,
+        key='retention_kind'
+    )
+    summary_data, cohort_data = get_retention(
+        st.session_state['dataset_version'], retention_kind, store.day_bitmaps(days)
+    )
+    if cohort_data.empty:
+        st.info('Нет данных для расчета удержания')
+    else:
+        retention_columns = st.columns(len(summary_data))
+        for column, row in zip(retention_columns, summary_data.to_dict('records')):
+            with column:
+                st.metric(
+                    f"Удержание {row['День']}",
+                    f"{row['Удержание, %']:.2f}%" if pd.notna(row['Удержание, %']) else '—',
+                    help=f"Вернулись {row['Вернулись']} из {row['Пользователей в когортах']} пользователей когорт, "
+                         'для которых этот день входит в период'
+                )
+        st.dataframe(cohort_data, hide_index=True, use_container_width=True)
+        st.caption(
+            'Доля пользователей когорты, активных (оплативших) через N дней, %. '
+            'Когорты считаются от начала выбранного периода'
+            f" (битовые карты: {bitmap_backend()})"
+        )
+    
+    # Активность по часам и скользящие окна - из куба час × день, без обращения к строкам
+    st.subheader('Активность по часам (UTC)')
+    heatmaps, rolling_data = get_activity_views(st.session_state['dataset_version'], combined_rollup)
+    if heatmaps is None:
+        st.info('Нет данных о времени транзакций для тепловой карты')
+        return
+    
+    heatmap_measure = st.radio(
+        'Мера',
+        options=list(HEATMAP_MEASURES),
+        format_func=HEATMAP_MEASURES.get,
+        horizontal=True,
+        key='heatmap_measure'
+    )
+    heatmap_data = heatmaps[heatmap_measure]
+    st.altair_chart(
+        alt.Chart(heatmap_data).mark_rect().encode(
+            x=alt.X('Час:O'),
+            y=alt.Y('Дата:O', sort='descending'),
+            color=alt.Color('Значение:Q', title=HEATMAP_MEASURES[heatmap_measure]),
+            tooltip=['Дата', 'Час', 'Значение']
+        ),
+        use_container_width=True
+    )
+    if heatmap_measure != 'amount':
+        st.caption('Уникальные пользователи в ячейке - оценка HyperLogLog (погрешность около 3%)')
+    
+    st.subheader('Скользящие окна')
+    rolling_data = rolling_data.set_index('Date')
+    st.line_chart(rolling_data[[column for column in rolling_data.columns if column.startswith('Пользователи')]])
+    st.line_chart(rolling_data[[column for column in rolling_data.columns if column.startswith('Сумма оплат')]])
+    st.caption('Значение за день - итог за N последних дней, включая его; пользователи - оценка HyperLogLog')
+
+# Функция для обновления дашборда по таймеру
+def render_live_dashboard(days):
+    # Отмечаем сессию в фоновой загрузке; если поток уже остановлен, перезапускаем скрипт целиком
+    if not join_live_tail(st.session_state['live_tail'], st.session_state['session_id']):
+        st.rerun()
+    # Дни периода, вытесненные из хранилища загрузками других сессий, догружаются здесь же
+    sync_partitions(st.session_state['s3_client'], days)
+    render_dashboard(days)
+
+if live_mode and st.session_state['s3_client'] is not None:
+    # Новые файлы догружает фоновый поток; фрагмент по таймеру перечитывает опубликованную версию
+    # (и догружает вытесненные дни), весь скрипт при этом не перезапускается
+    live_tail = get_live_tail(bucket_name, prefix, st.session_state['s3_client'])
+    if not join_live_tail(live_tail, st.session_state['session_id']):
+        # Поток остановлен, когда все сессии отключили автообновление - запускаем новый
+        get_live_tail.clear()
+        live_tail = get_live_tail(bucket_name, prefix, st.session_state['s3_client'])
+        join_live_tail(live_tail, st.session_state['session_id'])
+    st.session_state['live_tail'] = live_tail
+    live_tail['s3_client'] = st.session_state['s3_client']
+    live_tail['max_workers'] = max_workers
+    live_tail['parse_pool'] = get_parse_pool(parse_processes) if parse_processes else None
+    live_tail['compacted_prefix'] = compacted_prefix
+    st.fragment(run_every=live_interval)(render_live_dashboard)(selected_days)
+else:
+    # Автообновление выключено: сессия отключается от фонового потока
+    if st.session_state.get('live_tail') is not None:
+        leave_live_tail(st.session_state.pop('live_tail'), st.session_state['session_id'])
+    if st.session_state['s3_client'] is not None:
+        render_dashboard(selected_days)
+
+# Панель диагностики: время этапов загрузки и расчета метрик и счетчики (общие для процесса, все сессии)
+with st.sidebar.expander('🩺 Диагностика'):
+    counters = DIAGNOSTICS.snapshot()['counters']
+    st.caption(f"Статистика с {DIAGNOSTICS.started_at:%Y-%m-%d %H:%M:%S} UTC")
+    col1, col2 = st.columns(2)
+    col1.metric('Из кэша', counters.get('cache_hits', 0))
+    col2.metric('Из S3', counters.get('cache_misses', 0))
+    col1.metric('Строк TestMode', counters.get('testmode_dropped', 0), help='Отброшено строк с TestMode=true')
+    col2.metric('Битых строк', counters.get('bad_lines', 0), help='Пропущено строк, не являющихся JSON')
+    if counters.get('files_failed'):
+        st.caption(f"Файлов с ошибками: {counters['files_failed']}")
+    
+    stage_table = DIAGNOSTICS.stage_table()
+    if stage_table.empty:
+        st.caption('Замеров пока нет')
+    else:
+        st.dataframe(stage_table, hide_index=True, use_container_width=True)
+        st.caption('Время этапов суммируется по потокам; concat входит в merge, этапы metric: - только при пересчете')
+    
+    st.download_button(
+        'Скачать JSONL',
+        data=DIAGNOSTICS.to_jsonl(),
+        file_name='gift-dashboard-diagnostics.jsonl',
+        mime='application/x-ndjson',
+        help='Итоги по этапам и последние события по файлам, по одному JSON-объекту на строку'
+    )
+    if st.button('Сбросить статистику'):
+        DIAGNOSTICS.reset()
+        st.rerun()
 
 # Добавляем информацию о приложении
 st.sidebar.markdown('---')